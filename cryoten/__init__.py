@@ -1,7 +1,14 @@
+import json
 import os
+import threading
+import pyworkflow as pw
 import pyworkflow.utils as pwutils
 import pwem
-import subprocess
+
+from .constants import (CRYOTEN_CACHE_DIR, CRYOTEN_CACHE_SIZE, CRYOTEN_TUNING_FILE,
+                        CRYOTEN_ENGINE_DIR, CRYOTEN_HOME,
+                        CRYOTEN_ENV_ACTIVATION, CRYOTEN_ENV_NAME, CRYOTEN_ENV_FILE,
+                        CRYOTEN_CHECKS_FILE)
 
 __version__ = "1.0.0"  # plugin version
 _logo = "icon.png"
@@ -13,24 +20,136 @@ V1 = "1.0.0"
 class Plugin(pwem.Plugin):
     _url = "https://github.com/scipion-em/scipion-em-cryoten"
     _supportedVersions = [V1]  # binary version
+    _homeVar = CRYOTEN_HOME
+    _envInfo = None  # resolved once, see getEnvInfo
+    _envLock = threading.Lock()
+
+    @classmethod
+    def _defineVariables(cls):
+        cls._defineEmVar(CRYOTEN_HOME, 'cryoten-%s' % V1)
+        cls._defineVar(CRYOTEN_ENV_ACTIVATION, 'conda activate %s' % CRYOTEN_ENV_NAME)
+        cls._defineVar(CRYOTEN_CACHE_DIR, os.path.join(pw.Config.SCIPION_USER_DATA, 'cryoten_cache'))
+        cls._defineVar(CRYOTEN_CACHE_SIZE, '50')
+        cls._defineVar(CRYOTEN_TUNING_FILE,
+                       os.path.join(pw.Config.SCIPION_USER_DATA, 'cryoten_tuning.json'))
+        cls._defineVar(CRYOTEN_ENGINE_DIR,
+                       os.path.join(pw.Config.SCIPION_USER_DATA, 'cryoten_engines'))
+
+    @classmethod
+    def getResultCache(cls):
+        """ Cache of enhanced maps shared by all projects. """
+        from .cache import ResultCache
+        maxBytes = float(cls.getVar(CRYOTEN_CACHE_SIZE)) * 1024 ** 3
+        return ResultCache(os.path.expanduser(cls.getVar(CRYOTEN_CACHE_DIR)), maxBytes)
+
+    @classmethod
+    def registerImageReaders(cls):
+        """ Let Scipion read the compressed maps (.mrc.gz, .mrc.bz2 or .mrc.zst)
+        written by the protocol, see cryoten.convert. """
+        from .convert import registerImageReaders
+        registerImageReaders()
+
+    @classmethod
+    def getEngineDir(cls):
+        """ Folder of the graphs exported by the inference engines, writable by
+        the user even if the installation is not. """
+        return os.path.expanduser(cls.getVar(CRYOTEN_ENGINE_DIR))
+
+    @classmethod
+    def getTuner(cls):
+        """ Tile sizes learnt on each machine, shared by all projects. """
+        from .tuning import Tuner
+        return Tuner(os.path.expanduser(cls.getVar(CRYOTEN_TUNING_FILE)))
+
+    @classmethod
+    def getPreflight(cls):
+        """ Cached checks of the installation, see preflight.py. """
+        from .preflight import Preflight
+        return Preflight(cls.getHome(), cls.getCryotenPath())
 
     @classmethod
     def getEnvActivation(cls):
-        return f"conda activate cryoten_env"
+        return cls.getVar(CRYOTEN_ENV_ACTIVATION)
+
+    @classmethod
+    def getCryotenPath(cls, *paths):
+        """ Path inside the cloned cryoten repository. """
+        return cls.getHome('cryoten', *paths)
+
+    @classmethod
+    def getEnvInfo(cls):
+        """ Python interpreter and environment variables of the cryoten environment.
+        They are resolved once by activating the environment and cached in
+        cryoten_env.json, so programs are launched without going through conda.
+        """
+        with cls._envLock:
+            if cls._envInfo is None:
+                cls._envInfo = cls._loadEnvInfo() or cls._resolveEnvInfo()
+            return cls._envInfo
+
+    @classmethod
+    def _loadEnvInfo(cls):
+        envFile = cls.getHome(CRYOTEN_ENV_FILE)
+        if not os.path.exists(envFile):
+            return None
+        with open(envFile) as f:
+            envInfo = json.load(f)
+        # Activate again if the activation changed or the env was re-created elsewhere
+        if (envInfo.get('activation') != cls.getEnvActivation()
+                or not os.path.exists(envInfo.get('python', ''))):
+            return None
+        return envInfo
+
+    @classmethod
+    def _resolveEnvInfo(cls):
+        import subprocess
+        marker = 'CRYOTEN_ENV='
+        printEnv = ("import json, os, sys; "
+                    "print('%s' + json.dumps({'python': sys.executable, 'environ': dict(os.environ)}))"
+                    % marker)
+        cmd = '%s %s && python -c "%s"' % (cls.getCondaActivationCmd(), cls.getEnvActivation(), printEnv)
+        process = subprocess.run(['/bin/bash', '-c', cmd], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+        lines = [l for l in process.stdout.splitlines() if l.startswith(marker)]
+        if process.returncode != 0 or not lines:
+            raise Exception(f"Could not activate the cryoten environment with "
+                            f"'{cls.getEnvActivation()}': {process.stderr}")
+
+        activated = json.loads(lines[-1][len(marker):])
+        # Only keep what the activation changed, the rest comes from the caller
+        ignored = {'_', 'SHLVL', 'PWD', 'OLDPWD'}
+        environ = {k: v for k, v in activated['environ'].items()
+                   if k not in ignored and os.environ.get(k) != v}
+        envInfo = {'activation': cls.getEnvActivation(),
+                   'python': activated['python'],
+                   'environ': environ}
+        try:
+            with open(cls.getHome(CRYOTEN_ENV_FILE), 'w') as f:
+                json.dump(envInfo, f, indent=2)
+        except OSError:
+            pass  # Read-only installation, keep it only for this process
+        return envInfo
+
+    @classmethod
+    def getPython(cls):
+        """ Python interpreter of the cryoten environment. """
+        return cls.getEnvInfo()['python']
 
     @classmethod
     def getEnviron(cls, gpuID=None):
-        """ Setup the environment variables needed to launch the program. """
+        """ Setup the environment variables needed to launch the program.
+        An empty gpuID hides all the GPUs from the program. """
         environ = pwutils.Environ(os.environ)
+        environ.update(cls.getEnvInfo()['environ'])
 
         if gpuID is not None:
-            environ["CUDA_VISIBLE_DEVICES"] = gpuID
+            environ["CUDA_VISIBLE_DEVICES"] = str(gpuID)
 
         return environ
 
     @classmethod
     def getCryotenProgram(cls, program):
-        cmd = '%s %s && python %s' % (cls.getCondaActivationCmd(), cls.getEnvActivation(), program)
+        cmd = '%s %s' % (cls.getPython(), program)
         return cmd
 
     @classmethod
@@ -41,6 +160,8 @@ class Plugin(pwem.Plugin):
     def defineBinaries(cls, env):
         def getCryotenInstallationCommands():
             commands = cls.getCondaActivationCmd() + " "
+            # Forget the cached environment resolution of a previous install
+            commands += "rm -f %s %s && " % (CRYOTEN_ENV_FILE, CRYOTEN_CHECKS_FILE)
             # Remove existing cryoten directory if it exists
             commands += "if [ -d cryoten ]; then rm -rf cryoten; fi && "
             # Clone the cryoten repository
@@ -50,6 +171,8 @@ class Plugin(pwem.Plugin):
             # Download cryoten_v2.ckpt and rename it to cryoten.ckpt
             commands += "if [ ! -f cryoten_v2.ckpt ]; then wget https://zenodo.org/records/14736781/files/cryoten_v2.ckpt; fi && "
             commands += "mv cryoten_v2.ckpt cryoten.ckpt && "
+            # Record its hash, checked when protocols are validated
+            commands += "md5sum cryoten.ckpt > cryoten.ckpt.md5 && "
             # Remove existing conda environment if it exists
             commands += "conda remove -n cryoten_env --all -y && "
             # Create the conda environment
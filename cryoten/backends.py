@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Programs the protocol runs to enhance the maps.
+
+A backend gives the command of the persistent worker (scripts/cryoten_worker.py
+running an evaluation script), the folder and environment it runs in, and the
+file that identifies the model in the result cache keys:
+
+    cryoten: eval.py of the cryoten installation, run in its environment.
+    fake: scripts/stub_eval.py, a deterministic smoothing filter run by the
+        Scipion python, so the whole protocol (batches, cache, tiles, queue
+        jobs and errors) runs offline on CPU in seconds. Used by the tests.
+"""
+
+import os
+
+import pyworkflow as pw
+import pyworkflow.utils as pwutils
+
+from cryoten import Plugin
+from cryoten.scripts import getScript
+
+CRYOTEN = 'cryoten'
+FAKE = 'fake'
+
+
+class Backend:
+    """ Base class of the backends. """
+    program = None  # evaluation script, relative to the working folder
+    engines = None  # inference engines supported, None for all
+
+    def getWorkingPath(self):
+        """ Folder the worker runs in. """
+        raise NotImplementedError
+
+    def getPython(self):
+        raise NotImplementedError
+
+    def getCommand(self):
+        return [self.getPython(), getScript('cryoten_worker.py'), self.program]
+
+    def getJobEnviron(self):
+        """ Variables set on top of the environment of the caller, e.g. a queue job. """
+        return {}
+
+    def getEnviron(self, gpuID=None):
+        """ Environment of a worker, an empty gpuID hides all the GPUs. """
+        environ = pwutils.Environ(os.environ)
+        environ.update(self.getJobEnviron())
+        if gpuID is not None:
+            environ['CUDA_VISIBLE_DEVICES'] = str(gpuID)
+        return environ
+
+    def getModelPath(self):
+        """ File of the model weights. """
+        raise NotImplementedError
+
+    def validate(self):
+        """ Errors of the installation, only doing cheap (or cached) checks. """
+        return []
+
+    def getDevices(self):
+        """ GPUs seen by the backend ({'gpus': [{'name', 'memory'}]}), None if unknown. """
+        return None
+
+
+class CryotenBackend(Backend):
+    """ The cryoten network, installed by the plugin. """
+    program = 'eval.py'
+
+    def getWorkingPath(self):
+        cryotenPath = Plugin.getCryotenPath()
+        if not os.path.isdir(cryotenPath):
+            raise Exception(f"Cryoten path does not exist: {cryotenPath}")
+        return cryotenPath
+
+    def getPython(self):
+        return Plugin.getPython()
+
+    def getJobEnviron(self):
+        return dict(Plugin.getEnvInfo()['environ'])
+
+    def getEnviron(self, gpuID=None):
+        return Plugin.getEnviron(gpuID)
+
+    def getModelPath(self):
+        return Plugin.getCryotenPath('cryoten.ckpt')
+
+    def validate(self):
+        return Plugin.getPreflight().checkInstallation(Plugin.getEnvInfo, Plugin.getEnviron)
+
+    def getDevices(self):
+        return Plugin.getPreflight().getDevices()
+
+
+class FakeBackend(Backend):
+    """ Stand-in of the network that only needs numpy and mrcfile. """
+    program = 'stub_eval.py'
+    engines = ['eager']
+
+    def getWorkingPath(self):
+        return os.path.dirname(getScript(self.program))
+
+    def getPython(self):
+        return pw.PYTHON
+
+    def getModelPath(self):
+        return getScript(self.program)
+
+
+BACKENDS = {CRYOTEN: CryotenBackend, FAKE: FakeBackend}
+
+
+def getBackend(name):
+    if name not in BACKENDS:
+        raise Exception(f"Unknown backend {name}, use one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
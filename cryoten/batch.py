@@ -0,0 +1,195 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Enhancement of a list of maps or tiles by one persistent worker.
+
+The protocol runs the jobs of each worker in its own process, or writes
+them to a batch file that a queue job runs with:
+
+    scipion python -m cryoten.batch batch.json
+
+A job is a dict with the input and output maps, plus the tile of the
+input map to extract when the job is a tile:
+
+    {'input': ..., 'output': ..., 'tile': [mapPath, corner, shape]}
+
+The batch file has the name, command, cwd and extra environ of the worker,
+its jobs, the tuning settings (see runJobs) and the result file, where the
+start-up time and the phases of the worker, and the outputs of the jobs
+backed off to tiles, are written when all the jobs are done.
+"""
+
+import json
+import os
+import sys
+
+from cryoten import metrics, mrcio, runner, tiling, tuning
+from cryoten.worker import CryotenWorker
+
+
+def _enhance(worker, inputPath, outputPath, timer, tuningSettings, sizes):
+    """ Enhance a map, or if it runs out of memory, enhance it again in
+    smaller tiles blended into outputPath. The boxes enhanced and the ones
+    that ran out of memory are added to sizes. Returns the replies, the ones
+    of tiles with the size they were backed off to as 'backoff'. """
+    shape = mrcio.readHeader(inputPath).shape
+    voxels = shape[0] * shape[1] * shape[2]
+    try:
+        reply = worker.enhance(inputPath, outputPath)
+        sizes['okVoxels'] = max(sizes['okVoxels'], voxels)
+        return [reply]
+    except RuntimeError as e:
+        tileSize = tuning.getBackoffSize(max(shape))
+        if (tuningSettings is None or not tuning.isOutOfMemory(e)
+                or tileSize <= max(tuning.MIN_TILE_SIZE, 2 * tuningSettings['overlap'])):
+            raise
+        sizes['oomVoxels'] = min(sizes['oomVoxels'] or voxels, voxels)
+        print(f"{worker.name} ran out of memory with a box of {shape}, "
+              f"enhancing it in tiles of {tileSize}", flush=True)
+
+    tiles = tiling.getTiles(shape, tileSize, tuningSettings['overlap'])
+    basePath = os.path.splitext(outputPath)[0]
+    tilePaths = [f"{basePath}_split{i}.mrc" for i in range(len(tiles))]
+    replies = []
+    for (corner, tileShape), tilePath in zip(tiles, tilePaths):
+        tileInputPath = f"{basePath}_split_in.mrc"
+        with timer.measure('inputRead'):
+            tiling.extractTile(inputPath, corner, tileShape, tileInputPath)
+        tileReplies = _enhance(worker, tileInputPath, tilePath, timer, tuningSettings, sizes)
+        for reply in tileReplies:
+            reply.setdefault('backoff', tileSize)
+        replies += tileReplies
+        os.remove(tileInputPath)
+    with timer.measure('outputWrite'):
+        tiling.blendTiles(inputPath, outputPath, tiles, tilePaths, tuningSettings['overlap'],
+                          tuningSettings['maxMemory'], f"{basePath}_split_weights.dat")
+    for tilePath in tilePaths + [f"{basePath}_split_weights.dat"]:
+        if os.path.exists(tilePath):
+            os.remove(tilePath)
+    return replies
+
+
+def runJobs(worker, jobs, timer, onJobDone=None, tuningSettings=None):
+    """ Start worker, enhance the jobs and close it. Every output map is
+    checked, keeping the sampling and origin of the input for whole maps,
+    before calling onJobDone(job). Returns the start-up time of the worker.
+
+    If tuningSettings is given, maps that run out of memory are enhanced
+    again in smaller tiles, their jobs are marked with 'backoff', and the
+    sizes that worked or not are recorded.
+    It is a dict with the file of the cryoten.tuning.Tuner, the key of the
+    machine, and the tile overlap and maxMemory used to blend the tiles. """
+    sizes = {'okVoxels': 0, 'oomVoxels': None}
+    try:
+        with worker:
+            print(f"Cryoten {worker.name} ready in {worker.startupSeconds:.1f} seconds")
+            timer.add('workerStart', worker.startupSeconds, worker.startupCpu or 0.0)
+
+            for jobIndex, job in enumerate(jobs, start=1):
+                try:
+                    if 'tile' in job:
+                        # Lists when read from a batch file
+                        inputPath, corner, tileShape = (job['tile'][0],
+                                                        *map(tuple, job['tile'][1:]))
+                        with timer.measure('inputRead'):
+                            tiling.extractTile(inputPath, corner, tileShape, job['input'])
+                    else:
+                        inputHeader = mrcio.readHeader(job['input'])
+
+                    replies = _enhance(worker, job['input'], job['output'], timer,
+                                       tuningSettings, sizes)
+                finally:
+                    # Input tiles may be in shared memory, they are never left behind
+                    if 'tile' in job and os.path.exists(job['input']):
+                        os.remove(job['input'])
+                for reply in replies:
+                    timer.addReply(reply)
+                # Blended tiles do not give the same map as the whole map
+                if any('backoff' in reply for reply in replies):
+                    job['backoff'] = True
+                print(f"{worker.name} enhanced {job['input']} in "
+                      f"{sum(reply['seconds'] for reply in replies):.1f} seconds "
+                      f"({jobIndex}/{len(jobs)})", flush=True)
+
+                # Verify the output map, only reading its header
+                if 'tile' in job:
+                    mrcio.checkMap(job['output'], tileShape)
+                else:
+                    outputHeader = mrcio.checkMap(job['output'])
+                    # Keep the sampling and origin of the input, written in place
+                    if (outputHeader.shape == inputHeader.shape and
+                            (outputHeader.voxelSize, outputHeader.origin) !=
+                            (inputHeader.voxelSize, inputHeader.origin)):
+                        with timer.measure('outputWrite'):
+                            mrcio.writeGeometry(job['output'], inputHeader.voxelSize,
+                                                inputHeader.origin)
+
+                if onJobDone is not None:
+                    onJobDone(job)
+    finally:
+        # Also what was learnt before a failure
+        if tuningSettings is not None:
+            tuning.Tuner(tuningSettings['file']).record(tuningSettings['key'], **sizes)
+
+    return worker.startupSeconds
+
+
+def writeBatch(path, name, command, cwd, environ, jobs, tuningSettings=None):
+    """ Write the batch file of a worker, see main. The key of the machine
+    is left out of tuningSettings, it is found by the job. """
+    batch = {'name': name, 'command': command, 'cwd': cwd, 'environ': environ,
+             'jobs': jobs, 'tuning': tuningSettings,
+             'result': os.path.splitext(path)[0] + '_result.json'}
+    with open(path, 'w') as f:
+        json.dump(batch, f, indent=2)
+    return batch
+
+
+def main(batchPath):
+    with open(batchPath) as f:
+        batch = json.load(f)
+    # A cancelled queue job stops the worker too
+    runner.installSignalHandlers()
+
+    env = dict(os.environ)
+    env.update(batch['environ'])
+    worker = CryotenWorker(batch['command'], env=env, cwd=batch['cwd'], name=batch['name'])
+    # The GPU given by the queue, none for CPU jobs
+    device = env.get('CUDA_VISIBLE_DEVICES') or None
+    timer = metrics.PhaseTimer(gpu=device)
+    # The sizes are recorded for the node running the job
+    tuningSettings = batch.get('tuning')
+    if tuningSettings is not None:
+        tuningSettings = dict(tuningSettings, key=tuning.getMachineKey(device))
+    startupSeconds = runJobs(worker, batch['jobs'], timer, tuningSettings=tuningSettings)
+
+    with open(batch['result'], 'w') as f:
+        json.dump({'startupSeconds': startupSeconds, 'phases': timer.phases,
+                   'backoff': [job['output'] for job in batch['jobs'] if job.get('backoff')]},
+                  f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
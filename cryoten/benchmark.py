@@ -0,0 +1,224 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmarks of the enhancement paths with a stub model.
+
+Synthetic maps of several box sizes are enhanced through the real worker
+(scripts/cryoten_worker.py) running scripts/stub_eval.py instead of the
+cryoten network, so no GPU, checkpoint or network access is needed. Three
+paths are measured:
+
+    single: one map, including the worker start-up.
+    batch: several maps enhanced by the same worker.
+    tiled: one map cut in tiles, enhanced and blended back.
+
+Every case runs in a fresh process, so its peak memory is its own: the
+input maps are written beforehand by the parent process, and the tiles are
+blended with the memory of a single tile. Run it
+with the Scipion python and compare the JSON of two plugin versions with:
+
+    scipion python -m cryoten.benchmark -o new.json --compare old.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mrcfile
+import numpy as np
+
+from cryoten import mrcio, tiling
+from cryoten.metrics import peakRss
+from cryoten.scripts import getScript
+from cryoten.worker import CryotenWorker
+
+PATHS = ['single', 'batch', 'tiled']
+DEFAULT_SIZES = [64, 128, 256]
+DEFAULT_BATCH = 4
+
+
+def writeSyntheticMap(path, boxSize, seed=0):
+    """ Write a box of gaussian blobs plus noise, with a 1 A voxel size. """
+    rng = np.random.default_rng(seed)
+    grid = np.indices((boxSize,) * 3, dtype=np.float32)
+    data = rng.normal(0, 0.1, (boxSize,) * 3).astype(np.float32)
+    for center in rng.uniform(0.25, 0.75, (8, 3)) * boxSize:
+        dist2 = sum((g - c) ** 2 for g, c in zip(grid, center))
+        data += np.exp(-dist2 / (2 * (boxSize / 16) ** 2))
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = 1.0
+
+
+def writeInputs(path, boxSize, batch, workDir):
+    """ Write the input maps of a case in workDir, see runCase. """
+    nMaps = batch if path == 'batch' else 1
+    for i in range(nMaps):
+        writeSyntheticMap(_getInputPath(workDir, i), boxSize, seed=i)
+
+
+def _getInputPath(workDir, index):
+    return os.path.join(workDir, f'input_{index}.mrc')
+
+
+def _newWorker(workDir):
+    command = [sys.executable, getScript('cryoten_worker.py'), getScript('stub_eval.py')]
+    return CryotenWorker(command, env=dict(os.environ, CRYOTEN_STUB_TIMING='1'), cwd=workDir,
+                         name='benchmark')
+
+
+def runCase(path, boxSize, workDir, batch=DEFAULT_BATCH):
+    """ Run one benchmark case in this process and return its metrics. The
+    input maps must be in workDir already, see writeInputs. """
+    nMaps = batch if path == 'batch' else 1
+    inputs = [_getInputPath(workDir, i) for i in range(nMaps)]
+
+    # (input, output) pairs enhanced by the worker
+    jobs = [(p, p.replace('input_', 'output_')) for p in inputs]
+    tiles = []
+    if path == 'tiled':
+        tileSize = max(16, boxSize // 2)
+        overlap = tileSize // 8
+        tiles = tiling.getTiles(mrcio.readHeader(inputs[0]).shape, tileSize, overlap)
+        # Same hand-off as the protocol: input tiles in shared memory if possible
+        jobs = [(mrcio.getSharedPath(os.path.join(workDir, f'tile_{i}_in.mrc'),
+                                     4 * int(np.prod(shape))),
+                 os.path.join(workDir, f'tile_{i}.mrc'))
+                for i, (_, shape) in enumerate(tiles)]
+
+    metrics = {'path': path, 'boxSize': boxSize, 'maps': nMaps, 'tiles': len(tiles),
+               'voxels': nMaps * boxSize ** 3,
+               'readSeconds': 0.0, 'computeSeconds': 0.0, 'writeSeconds': 0.0,
+               'tileIoSeconds': 0.0, 'workerPeakRssBytes': 0}
+
+    t0 = time.time()
+    with _newWorker(workDir) as worker:
+        metrics['startupSeconds'] = time.time() - t0
+        for i, (inputPath, outputPath) in enumerate(jobs):
+            if tiles:
+                t = time.time()
+                tiling.extractTile(inputs[0], *tiles[i], inputPath)
+                metrics['tileIoSeconds'] += time.time() - t
+            reply = worker.enhance(inputPath, outputPath)
+            if tiles:
+                os.remove(inputPath)
+            metrics['workerPeakRssBytes'] = max(metrics['workerPeakRssBytes'],
+                                                reply.get('peakRss') or 0)
+            with open(outputPath + '.timing.json') as f:
+                timing = json.load(f)
+            for key in ['read', 'compute', 'write']:
+                metrics[key + 'Seconds'] += timing[key]
+
+    if tiles:
+        t = time.time()
+        tiling.blendTiles(inputs[0], os.path.join(workDir, 'output_0.mrc'), tiles,
+                          [outputPath for _, outputPath in jobs], overlap,
+                          4 * tileSize ** 3,
+                          os.path.join(workDir, 'weights.dat'))
+        metrics['tileIoSeconds'] += time.time() - t
+        mrcio.removeSharedFolder(workDir)
+
+    metrics['wallSeconds'] = time.time() - t0
+    metrics['voxelsPerSecond'] = metrics['voxels'] / metrics['wallSeconds']
+    metrics['peakRssBytes'] = peakRss()
+    return metrics
+
+
+def runBenchmark(sizes=DEFAULT_SIZES, paths=PATHS, batch=DEFAULT_BATCH):
+    """ Run every (path, size) case in its own process and collect the results. """
+    from cryoten import __version__
+    results = []
+    for boxSize in sizes:
+        for path in paths:
+            workDir = tempfile.mkdtemp(prefix='cryoten_benchmark_')
+            try:
+                writeInputs(path, boxSize, batch, workDir)
+                output = subprocess.check_output(
+                    [sys.executable, '-m', 'cryoten.benchmark', '--case', path,
+                     '--sizes', str(boxSize), '--batch', str(batch), '--workdir', workDir],
+                    universal_newlines=True)
+                results.append(json.loads(output.splitlines()[-1]))
+            finally:
+                shutil.rmtree(workDir, ignore_errors=True)
+
+    return {'version': __version__, 'host': platform.node(),
+            'python': platform.python_version(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+
+
+def compare(new, old):
+    """ Lines with the speed up of new over old for the cases in both. """
+    oldResults = {(r['path'], r['boxSize']): r for r in old['results']}
+    lines = []
+    for r in new['results']:
+        o = oldResults.get((r['path'], r['boxSize']))
+        if o is not None:
+            lines.append(f"{r['path']:>6} {r['boxSize']:>5}: "
+                         f"{o['wallSeconds']:.2f} s -> {r['wallSeconds']:.2f} s "
+                         f"(x{o['wallSeconds'] / r['wallSeconds']:.2f}), peak RSS "
+                         f"{o['peakRssBytes'] / 1024 ** 2:.0f} -> "
+                         f"{r['peakRssBytes'] / 1024 ** 2:.0f} MB")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='box sizes of the synthetic maps')
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=PATHS)
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH,
+                        help='number of maps of the batch path')
+    parser.add_argument('-o', '--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--case', choices=PATHS, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # A single case, run by runBenchmark in a new process
+        print(json.dumps(runCase(args.case, args.sizes[0], args.workdir, args.batch)))
+        return
+
+    results = runBenchmark(args.sizes, args.paths, args.batch)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(results, json.load(f))))
+
+
+if __name__ == '__main__':
+    main()
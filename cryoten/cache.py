@@ -0,0 +1,148 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from .utils import atomicPath, writeJson
+
+HASH_CHUNK = 16 * 1024 * 1024
+
+
+def fileHash(path):
+    """ sha256 of the file content, read in chunks so big maps are not loaded. """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def copyFile(src, dst):
+    """ Copy src to dst through a temporary file, so dst is only replaced by a
+    complete copy. Entries are never hard linked: the outputs of the projects
+    may be rewritten in place, and must not change the cached maps. """
+    with atomicPath(dst) as tmpPath:
+        shutil.copyfile(src, tmpPath)
+
+
+class ResultCache:
+    """ Content-addressed cache of enhanced maps.
+
+    Entries are keyed on the hash of the input map, the identity of the
+    checkpoint and the inference settings (see makeKey). The least recently
+    used entries are removed when the total size goes over maxBytes.
+
+    The cache is shared by every project and process. The lock only covers
+    the threads of this process, so entries may be evicted by another
+    process at any time, and a missing entry is never an error.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path, maxBytes):
+        self.path = path
+        self.maxBytes = maxBytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def makeKey(self, inputPath, checkpointPath, settings):
+        """ Cache key for enhancing inputPath with the given checkpoint and settings. """
+        key = {'input': fileHash(inputPath),
+               'checkpoint': self.checkpointHash(checkpointPath),
+               'settings': settings}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def checkpointHash(self, checkpointPath):
+        """ Hash of the checkpoint, only computed again if the file changes. """
+        stat = os.stat(checkpointPath)
+        realPath = os.path.realpath(checkpointPath)
+        indexFile = os.path.join(self.path, 'checkpoints.json')
+
+        with self._lock:
+            index = {}
+            if os.path.exists(indexFile):
+                with open(indexFile) as f:
+                    index = json.load(f)
+            entry = index.get(realPath)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                return entry['sha256']
+
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'sha256': fileHash(checkpointPath)}
+            index[realPath] = entry
+            writeJson(indexFile, index)
+            return entry['sha256']
+
+    def get(self, key, outputPath):
+        """ Copy the cached map for key to outputPath. Returns False on a miss,
+        leaving outputPath untouched. """
+        entryPath = self._getEntryPath(key)
+        if not os.path.exists(entryPath):
+            return False
+        try:
+            copyFile(entryPath, outputPath)
+        except FileNotFoundError:  # Evicted meanwhile
+            return False
+        # Refresh the entry for the LRU policy, the copy is good even if evicted since
+        try:
+            os.utime(entryPath)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def put(self, key, resultPath):
+        """ Store resultPath under key and evict old entries if needed. """
+        entryPath = self._getEntryPath(key)
+        os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+        copyFile(resultPath, entryPath)
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in maxBytes. """
+        with self._lock:
+            entries = []
+            for root, _, files in os.walk(self.path):
+                for name in files:
+                    if name.endswith('.mrc'):
+                        filePath = os.path.join(root, name)
+                        try:
+                            stat = os.stat(filePath)
+                        except FileNotFoundError:  # Evicted by another process
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, filePath))
+
+            total = sum(e[1] for e in entries)
+            for _, size, filePath in sorted(entries):
+                if total <= self.maxBytes:
+                    break
+                try:
+                    os.remove(filePath)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def _getEntryPath(self, key):
+        return os.path.join(self.path, key[:2], key + '.mrc')
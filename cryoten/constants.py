@@ -28,3 +28,42 @@ V1 = "1.0"
 
 MYPLUGIN_BINARY = "MYPLUGIN_BINARY"
 MYPLUGIN_HOME = "MYPLUGIN_HOME"
+
+CRYOTEN_HOME = "CRYOTEN_HOME"
+CRYOTEN_ENV_ACTIVATION = "CRYOTEN_ENV_ACTIVATION"
+CRYOTEN_ENV_NAME = "cryoten_env"
+CRYOTEN_ENV_FILE = "cryoten_env.json"  # cached resolution of the environment
+CRYOTEN_CHECKS_FILE = "cryoten_checks.json"  # cached checks of the installation
+
+# Result cache of enhanced maps
+CRYOTEN_CACHE_DIR = "CRYOTEN_CACHE_DIR"
+CRYOTEN_CACHE_SIZE = "CRYOTEN_CACHE_SIZE"  # in GB
+# Tile sizes learnt on each machine
+CRYOTEN_TUNING_FILE = "CRYOTEN_TUNING_FILE"
+# Graphs exported by the inference engines
+CRYOTEN_ENGINE_DIR = "CRYOTEN_ENGINE_DIR"
+
+# Inference engines of the workers
+ENGINE_EAGER = 0
+ENGINE_FLOAT16 = 1
+ENGINE_BFLOAT16 = 2
+ENGINE_INT8 = 3
+ENGINE_TORCHSCRIPT = 4
+ENGINE_ONNX = 5
+ENGINE_CHOICES = ['eager', 'float16', 'bfloat16', 'int8', 'torchscript', 'onnx']
+
+# Storage of the enhanced maps
+OUTPUT_FLOAT32 = 0
+OUTPUT_FLOAT16 = 1
+OUTPUT_PRECISION_CHOICES = ['float32', 'float16']
+COMPRESSION_NONE = 0
+COMPRESSION_GZIP = 1
+COMPRESSION_BZIP2 = 2
+COMPRESSION_ZSTD = 3
+COMPRESSION_CHOICES = ['none', 'gzip', 'bzip2', 'zstd']
+COMPRESSION_SUFFIXES = ['', '.gz', '.bz2', '.zst']
+
+# Maps of a volume that are enhanced
+FULL_MAP = 0
+HALF_MAP_1 = 1
+HALF_MAP_2 = 2
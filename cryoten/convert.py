@@ -0,0 +1,88 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Scipion access to the compressed maps written by mrcio.writeMap, so the
+enhanced volumes stored as .mrc.gz, .mrc.bz2 or .mrc.zst can be shown and
+opened like any other volume.
+"""
+
+import os
+
+import numpy as np
+from pwem.emlib.image.image_readers import ImageReader, ImageReadersRegistry
+
+from . import mrcio
+
+_registered = False
+
+
+class CompressedMrcReader(ImageReader):
+    """ Image reader of compressed MRC maps (.mrc.gz, .mrc.bz2 or .mrc.zst).
+    Other files with those suffixes go to the reader they had before. """
+    _previousReaders = {}  # by extension, see registerImageReaders
+
+    @staticmethod
+    def getCompatibleExtensions():
+        return [suffix.lstrip('.') for suffix in mrcio.CODECS]
+
+    @classmethod
+    def _getPreviousReader(cls, filePath):
+        """ Reader of filePath if it is not a compressed MRC map, else None. """
+        root, ext = os.path.splitext(filePath.split('@')[-1])
+        if root.lower().endswith('.mrc'):
+            return None
+        return cls._previousReaders[ext.lstrip('.').lower()]
+
+    @classmethod
+    def getDimensions(cls, filePath):
+        reader = cls._getPreviousReader(filePath)
+        if reader is not None:
+            return reader.getDimensions(filePath)
+        z, y, x = mrcio.readHeader(filePath.split('@')[-1]).shape
+        return x, y, z, 1
+
+    @classmethod
+    def open(cls, path):
+        reader = cls._getPreviousReader(path)
+        if reader is not None:
+            return reader.open(path)
+        with mrcio.openMap(path.split('@')[-1]) as mrc:
+            return np.array(mrc.data)
+
+    @classmethod
+    def write(cls, images, fileName, isStack=False, samplingRate=-1.):
+        reader = cls._getPreviousReader(fileName) or ImageReader
+        return reader.write(images, fileName, isStack, samplingRate)
+
+
+def registerImageReaders():
+    """ Register CompressedMrcReader, once per process. """
+    global _registered
+    if _registered:
+        return
+    for ext in CompressedMrcReader.getCompatibleExtensions():
+        CompressedMrcReader._previousReaders[ext] = ImageReadersRegistry.getReader(f"map.{ext}")
+    ImageReadersRegistry.addReader(CompressedMrcReader)
+    _registered = True
@@ -0,0 +1,60 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Fourier Shell Correlation between two maps.
+"""
+
+import numpy as np
+
+from . import mrcio
+
+
+def computeFSC(path1, path2, samplingRate):
+    """ FSC between the maps in path1 and path2 up to Nyquist.
+    Returns the frequencies (1/A) and the FSC value of each shell. """
+    with mrcio.openMap(path1) as mrc1, mrcio.openMap(path2) as mrc2:
+        if mrc1.data.shape != mrc2.data.shape:
+            raise Exception(f"Can not compute the FSC of maps with different shapes: "
+                            f"{mrc1.data.shape} and {mrc2.data.shape}")
+        shape = mrc1.data.shape
+        ft1 = np.fft.rfftn(mrc1.data.astype(np.float32))
+        ft2 = np.fft.rfftn(mrc2.data.astype(np.float32))
+
+    # Shell of each Fourier coefficient, with frequencies relative to each axis
+    freqs = [np.fft.fftfreq(n) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1])]
+    grid = np.meshgrid(*freqs, indexing='ij', sparse=True)
+    radius = np.sqrt(sum(g ** 2 for g in grid))
+    nShells = min(shape) // 2
+    shells = np.minimum(np.round(radius * 2 * nShells).astype(np.int64), nShells).ravel()
+
+    def shellSum(values):
+        return np.bincount(shells, weights=values.ravel(), minlength=nShells + 1)[:nShells]
+
+    cross = shellSum((ft1 * np.conj(ft2)).real)
+    power1 = shellSum(np.abs(ft1) ** 2)
+    power2 = shellSum(np.abs(ft2) ** 2)
+    values = cross / np.maximum(np.sqrt(power1 * power2), np.finfo(np.float64).tiny)
+    frequencies = np.arange(nShells) / (2 * nShells * samplingRate)
+    return frequencies, values
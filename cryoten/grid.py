@@ -0,0 +1,217 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Mapping of maps to the working grid of the network and back.
+
+The map is cropped to the box of its non-empty region, plus some padding,
+and Fourier resampled to the sampling the network works at. The enhanced
+map is then resampled back to the cropped box and pasted in a map with the
+original box, sampling and origin, so the enhanced map overlaps the input.
+The region search reads the input in slabs; the cropped box is kept in
+memory for the Fourier transforms, see getResampleBytes.
+"""
+
+import itertools
+import json
+
+import numpy as np
+
+from . import mrcio
+from .utils import writeJson
+
+SLAB_BYTES = 256 * 1024 ** 2
+
+
+def _iterSlabs(data):
+    """ Slices of z sections of data of about SLAB_BYTES. """
+    sectionBytes = data.shape[1] * data.shape[2] * data.dtype.itemsize
+    step = max(1, SLAB_BYTES // sectionBytes)
+    for z in range(0, data.shape[0], step):
+        yield slice(z, z + step)
+
+
+def getAutoThreshold(data, sigmas=3.0):
+    """ mean + sigmas * std of the map, computed slab by slab. """
+    total, total2, n = 0.0, 0.0, 0
+    for section in _iterSlabs(data):
+        slab = np.asarray(data[section], dtype=np.float64)
+        total += slab.sum()
+        total2 += (slab ** 2).sum()
+        n += slab.size
+    mean = total / n
+    return mean + sigmas * np.sqrt(max(total2 / n - mean ** 2, 0.0))
+
+
+def findRegion(path, threshold=None, padding=0):
+    """ (start, stop) along (z, y, x) of the voxels above threshold (automatic
+    if None), grown by padding voxels and clipped to the box. The whole box
+    is returned if no voxel is above the threshold. """
+    with mrcio.mapData(path) as mrc:
+        data = mrc.data
+        if threshold is None:
+            threshold = getAutoThreshold(data)
+        lows = np.array(data.shape)
+        highs = np.zeros(3, dtype=int)
+        for section in _iterSlabs(data):
+            mask = np.asarray(data[section]) > threshold
+            if not mask.any():
+                continue
+            for axis in range(3):
+                other = tuple(a for a in range(3) if a != axis)
+                indexes = np.flatnonzero(mask.any(axis=other))
+                if axis == 0:
+                    indexes = indexes + section.start
+                lows[axis] = min(lows[axis], indexes[0])
+                highs[axis] = max(highs[axis], indexes[-1] + 1)
+        shape = data.shape
+
+    if (highs <= lows).any():
+        return [(0, n) for n in shape]
+    return [(max(0, int(low) - padding), min(n, int(high) + padding))
+            for low, high, n in zip(lows, highs, shape)]
+
+
+def fourierResample(data, shape):
+    """ Resample data to shape by cropping or zero padding its Fourier
+    transform, which keeps the values of the map. The transforms are real
+    and in single precision, see getResampleBytes for the memory used. """
+    from scipy import fft
+    data = np.asarray(data, dtype=np.float32)
+    shape = tuple(shape)
+    if shape == data.shape:
+        return data.copy()
+
+    ft = fft.rfftn(data)
+    # Frequencies kept along each axis, as (source, destination) slices. The
+    # positive ones are at the start and the negative ones at the end, except
+    # in the last axis, that only has the positive half.
+    slices = []
+    for n, m in zip(data.shape[:-1], shape[:-1]):
+        k = min(n, m)
+        axisSlices = [(slice(0, (k + 1) // 2), slice(0, (k + 1) // 2))]
+        if k // 2:
+            axisSlices.append((slice(n - k // 2, n), slice(m - k // 2, m)))
+        slices.append(axisSlices)
+    k = min(data.shape[-1], shape[-1]) // 2 + 1
+    slices.append([(slice(0, k), slice(0, k))])
+
+    result = np.zeros(shape[:-1] + (shape[-1] // 2 + 1,), dtype=np.complex64)
+    for block in itertools.product(*slices):
+        result[tuple(dst for _, dst in block)] = ft[tuple(src for src, _ in block)]
+    del ft
+    resampled = fft.irfftn(result, s=shape, overwrite_x=True)
+    resampled *= np.prod(shape) / data.size
+    return resampled.astype(np.float32, copy=False)
+
+
+def getResampleBytes(shape, workShape):
+    """ Peak memory of fourierResample between shape and workShape, in bytes:
+    the input and its transform, the transform of the output and the output. """
+    if list(shape) == list(workShape):
+        return 0
+    return 8 * (int(np.prod(shape)) + int(np.prod(workShape)))
+
+
+def getTransform(path, samplingRate=None, threshold=None, padding=0, crop=True, region=None):
+    """ Transform from the map in path to the working grid: the region to
+    crop (the whole box if not crop) and the shape it is resampled to, so
+    the voxels get samplingRate (kept if None). The region to crop can be
+    given instead of found from the threshold. """
+    header = mrcio.readHeader(path)
+    if region is not None:
+        region = [tuple(r) for r in region]
+    elif crop:
+        region = findRegion(path, threshold, padding)
+    else:
+        region = [(0, n) for n in header.shape]
+    cropShape = [stop - start for start, stop in region]
+    # voxelSize is (x, y, z) and shapes (z, y, x)
+    inputSampling = header.voxelSize[::-1]
+    if samplingRate:
+        workShape = [max(1, int(round(n * s / samplingRate)))
+                     for n, s in zip(cropShape, inputSampling)]
+    else:
+        workShape = cropShape
+    return {'shape': list(header.shape), 'region': [list(r) for r in region],
+            'workShape': workShape, 'voxelSize': list(header.voxelSize),
+            'origin': list(header.origin)}
+
+
+def getCropOrigin(transform):
+    """ Origin (x, y, z) in Angstroms of the cropped region of a map. """
+    return tuple(o + start * s for o, (start, _), s in zip(transform['origin'],
+                                                          transform['region'][::-1],
+                                                          transform['voxelSize']))
+
+
+def prepareMap(inputPath, outputPath, transform):
+    """ Write the input map cropped and resampled to the working grid. """
+    region = transform['region']
+    cropShape = [stop - start for start, stop in region]
+    with mrcio.mapData(inputPath) as mrc:
+        data = fourierResample(mrc.data[tuple(slice(*r) for r in region)],
+                               transform['workShape'])
+
+    # Actual sampling after rounding the shape, as (x, y, z)
+    workSampling = tuple(s * n / m for s, n, m in zip(transform['voxelSize'],
+                                                    cropShape[::-1],
+                                                    transform['workShape'][::-1]))
+    mrc = mrcio.createMap(outputPath, data.shape, workSampling, getCropOrigin(transform))
+    try:
+        mrc.data[:] = data
+    finally:
+        mrc.close()
+
+
+def restoreMap(enhancedPath, outputPath, transform, crop=False):
+    """ Map the enhanced map on the working grid back to the original box,
+    sampling and origin. Voxels out of the cropped region are 0. If crop,
+    only the cropped region is written, with its origin shifted. """
+    region = transform['region']
+    cropShape = [stop - start for start, stop in region]
+    with mrcio.mapData(enhancedPath) as mrc:
+        data = fourierResample(mrc.data, cropShape)
+
+    if crop:
+        mrc = mrcio.createMap(outputPath, tuple(cropShape), tuple(transform['voxelSize']),
+                              getCropOrigin(transform))
+        region = [(0, n) for n in cropShape]
+    else:
+        mrc = mrcio.createMap(outputPath, tuple(transform['shape']),
+                              tuple(transform['voxelSize']), tuple(transform['origin']))
+    try:
+        # New maps are zero filled, only the region is written
+        mrc.data[tuple(slice(*r) for r in region)] = data
+    finally:
+        mrc.close()
+
+
+def saveTransform(path, transform):
+    writeJson(path, transform)
+
+
+def loadTransform(path):
+    with open(path) as f:
+        return json.load(f)
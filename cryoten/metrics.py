@@ -0,0 +1,126 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import contextlib
+import resource
+import sys
+import time
+
+# Phases of an enhancement, in execution order, and their labels
+PHASES = {
+    'environment': 'environment resolution',
+    'workerStart': 'worker start-up',
+    'inputRead': 'input read',
+    'gridMapping': 'grid mapping',
+    'modelLoad': 'model load',
+    'inference': 'inference',
+    'outputWrite': 'output write',
+    'registration': 'output registration',
+}
+
+
+def peakRss():
+    """ Peak resident memory of this process in bytes. It is read from /proc
+    on Linux, where getrusage keeps the peak of the parent across fork and exec. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes in macOS, kilobytes elsewhere
+    return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+
+class PhaseTimer:
+    """ Wall time, CPU time, peak memory and GPU of the phases of a worker.
+
+    Phases are accumulated, so a phase run once per map gives the total:
+
+        timer = PhaseTimer(gpu='0')
+        with timer.measure('inputRead'):
+            ...
+        timer.add('inference', wall=12.0, cpu=40.0, peakRss=2 ** 30)
+    """
+    def __init__(self, gpu=None):
+        self.gpu = gpu
+        self.phases = {}
+
+    def add(self, phase, wall, cpu, peakRss=None, gpuPeakBytes=None):
+        stats = self.phases.setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'peakRss': 0,
+                                               'gpuPeakBytes': None, 'gpu': self.gpu})
+        stats['wall'] += wall
+        stats['cpu'] += cpu
+        stats['peakRss'] = max(stats['peakRss'], peakRss or 0)
+        if gpuPeakBytes is not None:
+            stats['gpuPeakBytes'] = max(stats['gpuPeakBytes'] or 0, gpuPeakBytes)
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """ Measure a phase run by this thread. """
+        t0, c0 = time.time(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - t0, time.thread_time() - c0, peakRss())
+
+    def addReply(self, reply):
+        """ Add the phases of a job reported by the cryoten worker. """
+        for phase, stats in reply.get('phases', {}).items():
+            self.add(phase, stats['wall'], stats['cpu'], reply.get('peakRss'),
+                     reply.get('gpuPeakBytes') if phase == 'inference' else None)
+
+
+def mergePhases(phasesList):
+    """ Total of several phase dictionaries: times are added, peak memory is
+    the maximum and gpus lists the GPUs where each phase ran. """
+    total = {}
+    for phases in phasesList:
+        for phase, stats in phases.items():
+            merged = total.setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'peakRss': 0,
+                                              'gpuPeakBytes': None, 'gpus': []})
+            merged['wall'] += stats['wall']
+            merged['cpu'] += stats['cpu']
+            merged['peakRss'] = max(merged['peakRss'], stats.get('peakRss') or 0)
+            if stats.get('gpuPeakBytes') is not None:
+                merged['gpuPeakBytes'] = max(merged['gpuPeakBytes'] or 0, stats['gpuPeakBytes'])
+            if stats.get('gpu') is not None and stats['gpu'] not in merged['gpus']:
+                merged['gpus'].append(stats['gpu'])
+    # Known phases first, in execution order
+    return {phase: total[phase] for phase in sorted(
+        total, key=lambda p: list(PHASES).index(p) if p in PHASES else len(PHASES))}
+
+
+def formatPhase(phase, stats):
+    """ One line summary of a phase. """
+    line = (f"{PHASES.get(phase, phase)}: {stats['wall']:.1f} s "
+            f"(CPU {stats['cpu']:.1f} s, peak {stats['peakRss'] / 1024 ** 2:.0f} MB")
+    if stats.get('gpuPeakBytes'):
+        line += f", GPU peak {stats['gpuPeakBytes'] / 1024 ** 2:.0f} MB"
+    if stats.get('gpus'):
+        line += f", GPU {','.join(stats['gpus'])}"
+    return line + ")"
@@ -0,0 +1,239 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Memory mapped access to MRC maps.
+
+Headers are checked without reading the data, the data is memory mapped so
+only the pages actually used are read, and new maps are created at their
+final size and filled in place. The temporary maps handed to the cryoten
+worker are placed in shared memory (/dev/shm) when there is room for them,
+so they are exchanged through the page cache without reaching the disk.
+
+The enhanced maps can be stored in float16 and compressed (gzip, bzip2 or
+zstd, chosen by the file suffix). They are written as a stream from a
+mapped float32 map, so no full copy of the data is ever in memory.
+"""
+
+import bz2
+import contextlib
+import gzip
+import hashlib
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+import mrcfile
+from mrcfile.mrcinterpreter import MrcInterpreter
+
+from .utils import atomicPath
+
+SHARED_MEMORY_DIR = '/dev/shm'
+HEADER_BYTES = 1024
+SLAB_BYTES = 64 * 1024 ** 2  # data converted at a time when streaming a map
+
+# shape is (z, y, x), voxelSize and origin are (x, y, z) in Angstroms
+MapHeader = namedtuple('MapHeader', ['shape', 'voxelSize', 'origin', 'dtype'])
+
+
+def _openZstd(path, mode):
+    try:
+        from compression import zstd  # Python >= 3.14
+    except ImportError:
+        import zstandard as zstd
+    return zstd.open(path, mode)
+
+
+# Openers of the compressed maps, by file suffix
+CODECS = {'.gz': gzip.open, '.bz2': bz2.open, '.zst': _openZstd}
+
+
+def getCodec(path):
+    """ Opener of a compressed map, None if path is not compressed. """
+    return next((codec for suffix, codec in CODECS.items() if path.endswith(suffix)), None)
+
+
+def isCodecAvailable(suffix):
+    """ Whether compressed maps with suffix can be written and read here. """
+    if suffix != '.zst':
+        return suffix in CODECS
+    try:
+        from compression import zstd  # noqa: F401
+    except ImportError:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return False
+    return True
+
+
+@contextlib.contextmanager
+def openMap(path, headerOnly=False):
+    """ Open a map to read it, memory mapped unless it is compressed, in
+    which case its data is decompressed in memory. """
+    codec = getCodec(path)
+    if codec is None:
+        with (mrcfile.open(path, header_only=True, permissive=True) if headerOnly
+              else mapData(path)) as mrc:
+            yield mrc
+    else:
+        with codec(path, 'rb') as stream:
+            yield MrcInterpreter(iostream=stream, permissive=True, header_only=headerOnly)
+
+
+def readHeader(path):
+    """ Geometry of a map, only reading its header. """
+    with openMap(path, headerOnly=True) as mrc:
+        return _getHeader(mrc)
+
+
+def _getHeader(mrc):
+    header = mrc.header
+    return MapHeader((int(header.nz), int(header.ny), int(header.nx)),
+                     tuple(float(v) for v in mrc.voxel_size.item()),
+                     tuple(float(v) for v in header.origin.item()),
+                     np.dtype(mrcfile.utils.data_dtype_from_header(header)))
+
+
+def checkMap(path, shape=None):
+    """ Check that path is a complete map (of the given shape) without reading
+    its data. Raises an Exception describing the problem otherwise. """
+    if not os.path.isfile(path):
+        raise Exception(f"Map was not created: {path}")
+    try:
+        with openMap(path, headerOnly=True) as mrc:
+            header = _getHeader(mrc)
+            extendedBytes = int(mrc.header.nsymbt)
+    except Exception as e:
+        raise Exception(f"Invalid map header in {path}: {e}")
+
+    if shape is not None and header.shape != tuple(shape):
+        raise Exception(f"Map {path} has shape {header.shape} instead of {tuple(shape)}")
+    if getCodec(path) is not None:
+        return header  # Written by writeMap, that only leaves complete files
+    dataBytes = header.dtype.itemsize * int(np.prod(header.shape))
+    if os.path.getsize(path) < HEADER_BYTES + extendedBytes + dataBytes:
+        raise Exception(f"Map {path} is truncated")
+    return header
+
+
+def mapData(path, writable=False):
+    """ Open a map with its data memory mapped. Use it as a context manager. """
+    return mrcfile.mmap(path, mode='r+' if writable else 'r', permissive=True)
+
+
+def createMap(path, shape, voxelSize, origin=None):
+    """ Create a float32 map of the given shape with its data memory mapped,
+    to be filled in place. The caller must close it. """
+    mrc = mrcfile.new_mmap(path, shape, mrc_mode=2, overwrite=True)
+    mrc.voxel_size = voxelSize
+    if origin is not None:
+        mrc.header.origin = origin
+    return mrc
+
+
+def writeGeometry(path, voxelSize, origin):
+    """ Set the voxel size and origin of an existing map. Only the header is
+    written, the data is mapped but not touched. """
+    with mapData(path, writable=True) as mrc:
+        mrc.voxel_size = voxelSize
+        mrc.header.origin = origin
+
+
+def writeMap(inputPath, outputPath, dtype=np.float32, slabBytes=SLAB_BYTES):
+    """ Write the map in inputPath to outputPath with its data as dtype,
+    compressed if the suffix of outputPath is one of CODECS. The data is
+    converted and written in slabs of sections, and outputPath only appears
+    once it is complete. """
+    with mapData(inputPath) as mrc:
+        data = mrc.data
+        step = max(1, slabBytes // max(1, data[0].nbytes))
+        slabs = [slice(z, z + step) for z in range(0, data.shape[0], step)]
+
+        # The statistics go in the header, before the data
+        dmin, dmax, total, squares = np.inf, -np.inf, 0.0, 0.0
+        for slab in slabs:
+            values = data[slab].astype(np.float64)
+            dmin, dmax = min(dmin, values.min()), max(dmax, values.max())
+            total += values.sum()
+            squares += np.square(values).sum()
+        mean = total / data.size
+
+        header = mrc.header.copy()
+        header.mode = mrcfile.utils.mode_from_dtype(np.dtype(dtype))
+        header.nsymbt = 0
+        header.dmin, header.dmax, header.dmean = dmin, dmax, mean
+        header.rms = np.sqrt(max(0.0, squares / data.size - mean ** 2))
+        outputDtype = mrcfile.utils.data_dtype_from_header(header)
+
+        with atomicPath(outputPath) as tmpPath, \
+                (getCodec(outputPath) or open)(tmpPath, 'wb') as f:
+            f.write(header.tobytes())
+            for slab in slabs:
+                f.write(np.ascontiguousarray(data[slab], dtype=outputDtype).tobytes())
+
+
+def getSharedPath(path, nbytes):
+    """ Equivalent of the scratch file path in shared memory, or path itself if
+    there is no shared memory or less than twice nbytes free in it. The
+    shared folder of each scratch folder is removed with removeSharedFolder. """
+    sharedFolder = _getSharedFolder(os.path.dirname(path))
+    if sharedFolder is None or shutil.disk_usage(SHARED_MEMORY_DIR).free < 2 * nbytes:
+        return path
+    os.makedirs(sharedFolder, exist_ok=True)
+    return os.path.join(sharedFolder, os.path.basename(path))
+
+
+def removeSharedFolder(folder):
+    """ Remove the shared memory folder used for the files of folder. """
+    sharedFolder = _getSharedFolder(folder)
+    if sharedFolder is not None:
+        shutil.rmtree(sharedFolder, ignore_errors=True)
+
+
+def removeSharedFiles(paths):
+    """ Remove the shared memory equivalents of the scratch files paths, see
+    getSharedPath, and their shared folders once they are empty. """
+    sharedFolders = set()
+    for path in paths:
+        sharedFolder = _getSharedFolder(os.path.dirname(path))
+        if sharedFolder is None:
+            continue
+        sharedFolders.add(sharedFolder)
+        sharedPath = os.path.join(sharedFolder, os.path.basename(path))
+        if os.path.exists(sharedPath):
+            os.remove(sharedPath)
+    for sharedFolder in sharedFolders:
+        try:
+            os.rmdir(sharedFolder)
+        except OSError:
+            pass  # Missing, or still used by other steps
+
+
+def _getSharedFolder(folder):
+    if not os.path.isdir(SHARED_MEMORY_DIR) or not os.access(SHARED_MEMORY_DIR, os.W_OK):
+        return None
+    key = hashlib.md5(os.path.abspath(folder).encode()).hexdigest()[:16]
+    return os.path.join(SHARED_MEMORY_DIR, f"cryoten_{os.getuid()}_{key}")
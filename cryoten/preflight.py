@@ -0,0 +1,205 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Fast checks of the cryoten installation run when a protocol is validated.
+
+The slow checks (hashing the checkpoint, starting the interpreter of the
+cryoten environment) are done once and cached in cryoten_checks.json in
+the installation folder, next to the checkpoint they refer to. A cached
+check is valid while the checkpoint or interpreter keep their size and
+modification time. Failed checks are not cached, so they are retried once
+the installation is fixed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+
+from .constants import CRYOTEN_CHECKS_FILE
+from .utils import writeJson
+
+CHECKPOINT = 'cryoten.ckpt'
+# Rough peak host memory per voxel of a map being enhanced (input, output
+# and the float copies made by eval.py)
+HOST_BYTES_PER_VOXEL = 32
+
+_lock = threading.Lock()
+
+# Printed by the interpreter of the environment, torch is optional
+_DEVICES_SCRIPT = """
+import json, sys
+info = {'python': sys.version.split()[0], 'torch': None, 'gpus': None, 'onnxruntime': None}
+try:
+    import onnxruntime
+except ImportError:
+    pass
+else:
+    info['onnxruntime'] = onnxruntime.__version__
+try:
+    import torch
+except ImportError:
+    pass
+else:
+    info['torch'] = torch.__version__
+    info['gpus'] = [{'name': torch.cuda.get_device_name(i),
+                     'memory': torch.cuda.get_device_properties(i).total_memory}
+                    for i in range(torch.cuda.device_count())]
+print(json.dumps(info))
+"""
+
+
+def _fileStamp(path):
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_size, stat.st_mtime]
+
+
+def _md5(path, blockSize=16 * 1024 ** 2):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class Preflight:
+    """ Checks of the installation in home, the folder of the plugin binaries. """
+    def __init__(self, home, cryotenPath):
+        self.home = home
+        self.cryotenPath = cryotenPath
+        self.checksFile = os.path.join(home, CRYOTEN_CHECKS_FILE)
+
+    def _load(self):
+        try:
+            with open(self.checksFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, checks):
+        try:
+            writeJson(self.checksFile, checks)
+        except OSError:
+            pass  # Read-only installation, checked again next time
+
+    def checkInstallation(self, getEnvInfo, getEnviron):
+        """ Errors of the installation: the cryoten folder, the checkpoint and
+        its hash and the interpreter of the environment. getEnvInfo and
+        getEnviron are the ones of the plugin, only called if needed. """
+        if not os.path.isdir(self.cryotenPath):
+            return [f"Cryoten is not installed, {self.cryotenPath} does not exist. "
+                    f"Install it with: scipion3 installb cryoten"]
+
+        with _lock:
+            checks = self._load()
+            errors = self._checkCheckpoint(checks)
+            try:
+                errors += self._checkEnvironment(checks, getEnvInfo, getEnviron)
+            except Exception as e:
+                errors.append(f"The cryoten environment can not be used: {e}")
+            self._save(checks)
+        return errors
+
+    def _checkCheckpoint(self, checks):
+        checkpoint = os.path.join(self.cryotenPath, CHECKPOINT)
+        if not os.path.isfile(checkpoint):
+            return [f"The cryoten checkpoint {checkpoint} is missing, "
+                    f"install cryoten again."]
+
+        stamp = _fileStamp(checkpoint)
+        cached = checks.get('checkpoint', {})
+        if cached.get('stamp') == stamp:
+            return []
+
+        # The hash of the downloaded checkpoint is recorded by the installation;
+        # older installations record the first one seen
+        md5 = _md5(checkpoint)
+        md5File = checkpoint + '.md5'
+        if os.path.exists(md5File):
+            with open(md5File) as f:
+                expected = f.read().split()[0]
+        else:
+            expected = md5
+            try:
+                with open(md5File, 'w') as f:
+                    f.write(f"{md5}  {CHECKPOINT}\n")
+            except OSError:
+                pass
+        if md5 != expected:
+            return [f"The cryoten checkpoint {checkpoint} is corrupted or was modified "
+                    f"(md5 {md5} instead of {expected}), install cryoten again."]
+        checks['checkpoint'] = {'stamp': stamp, 'md5': md5}
+        return []
+
+    def _checkEnvironment(self, checks, getEnvInfo, getEnviron):
+        envInfo = getEnvInfo()
+        python = envInfo['python']
+        if not os.path.isfile(python):
+            return [f"The python of the cryoten environment {python} does not exist."]
+
+        # Checked again if the script changes, e.g. to report more packages
+        key = {'stamp': _fileStamp(python), 'environ': envInfo['environ'],
+               'script': hashlib.md5(_DEVICES_SCRIPT.encode()).hexdigest()}
+        cached = checks.get('environment', {})
+        if all(cached.get(k) == v for k, v in key.items()):
+            return []
+
+        process = subprocess.run([python, '-c', _DEVICES_SCRIPT], env=getEnviron(),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, timeout=300)
+        if process.returncode != 0:
+            return [f"The python of the cryoten environment {python} failed:\n"
+                    + process.stderr[-2000:]]
+        checks['environment'] = dict(key, devices=json.loads(process.stdout.splitlines()[-1]))
+        return []
+
+    def getDevices(self):
+        """ Torch and onnxruntime versions and GPUs ({'name', 'memory'}) seen by
+        the environment when it was checked, None if they are not known. """
+        return self._load().get('environment', {}).get('devices')
+
+
+def checkDiskSpace(path, neededBytes):
+    """ Error if the file system of path has less than neededBytes free. """
+    free = shutil.disk_usage(path).free
+    if free < neededBytes:
+        return [f"Not enough disk space in {path}: {neededBytes / 1024 ** 3:.1f} GB "
+                f"needed, {free / 1024 ** 3:.1f} GB free."]
+    return []
+
+
+def getHostMemory():
+    """ Physical memory of this machine in bytes, None if unknown. """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimateHostMemory(shape):
+    """ Peak host memory of a worker enhancing a map (or tile) of shape. """
+    return HOST_BYTES_PER_VOXEL * shape[0] * shape[1] * shape[2]
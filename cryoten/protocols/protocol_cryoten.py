@@ -1,23 +1,61 @@
 import os
-import subprocess
+import glob
+import json
+import threading
+import time
+import pyworkflow as pw
 from pyworkflow.constants import BETA
 import pyworkflow.protocol.params as params
-from pyworkflow.utils import Message
+from pyworkflow.utils import Environ, Message, cleanPath
 from pwem.protocols import EMProtocol
-from pyworkflow.protocol import String
-from pwem.objects import Volume  # Import the Volume class to define the output
+from pyworkflow.protocol import String, Integer, STEPS_PARALLEL, STATUS_NEW, MODE_RESTART
+from pyworkflow.object import Set
+from pwem.objects import Volume, SetOfVolumes, FSC, Transform  # Import the Volume class to define the output
+
+# Only the modules needed to define the protocol are imported here, the ones
+# that run it are imported where used, to keep the protocol discovery fast
+from cryoten import Plugin, V1, metrics, mrcio, runner
+from cryoten.utils import atomicPath, writeJson
+from cryoten.constants import (ENGINE_CHOICES, ENGINE_EAGER, ENGINE_FLOAT16, ENGINE_INT8,
+                               ENGINE_ONNX,
+                               OUTPUT_FLOAT32, OUTPUT_PRECISION_CHOICES,
+                               COMPRESSION_NONE, COMPRESSION_CHOICES, COMPRESSION_SUFFIXES,
+                               FULL_MAP, HALF_MAP_1, HALF_MAP_2)
+
 
 class CryotenPrefixEnhace(EMProtocol):
     """
     This protocol will enhance the map using Cryoten software.
+    It accepts a single volume or a set of volumes. The volumes are spread
+    over one persistent cryoten worker per GPU (or per thread when no GPU
+    is given), so each worker loads the model only once. Large maps can be
+    processed in overlapping tiles to bound the memory used. The half maps
+    of the volumes can be enhanced in the same run, with the FSC between
+    the enhanced halves as a quick quality check. Maps can be cropped to
+    their non-empty region and resampled to the sampling of the network,
+    and the result is mapped back to the original box and origin.
+    An open set of volumes is processed in streaming: new volumes are
+    enhanced as they arrive and added to an open output set.
+    The enhanced maps and tiles are recorded in extra/progress, so
+    continuing an interrupted run only enhances what is missing.
     IMPORTANT: Classes names should be unique, better prefix them
     """
     _label = 'enhance map'
     _devStatus = BETA
+    stepsExecutionMode = STEPS_PARALLEL
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.outputFilePath = None  # Initialize the outputFilePath attribute
+        self.cacheHits = Integer(0)
+        self.cacheMisses = Integer(0)
+        self.tunedTileSize = Integer()
+        self._cacheLookups = {}
+        self._mapLocks = {}
+        self._mapLocksLock = threading.Lock()
+        # Enhanced maps may be stored compressed, they are read by the
+        # processes that load this protocol, the run and the GUI ones
+        Plugin.registerImageReaders()
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -25,149 +63,1175 @@ class CryotenPrefixEnhace(EMProtocol):
         Params:
             form: this is the form to be populated with sections and params.
         """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution",
+                       help="This protocol has both CPU and GPU implementation. "
+                            "Select the one you want to use.")
         form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
                        help="Add a list of GPU devices that can be used")
+        form.addHidden('backend', params.StringParam, default='cryoten',
+                       label='Backend',
+                       help='Program that enhances the maps, see cryoten/backends.py. '
+                            'The fake backend runs offline without cryoten, for tests.')
 
         form.addSection(label=Message.LABEL_INPUT)
 
         form.addParam('inputVolume', params.PointerParam,
-                      label='Input Volume',
-                      pointerClass='Volume',
-                      help='Select the volume to be processed.')
+                      label='Input Volume(s)',
+                      pointerClass='Volume, SetOfVolumes',
+                      help='Select the volume or the set of volumes to be processed. '
+                           'The volumes of a set are distributed among the GPUs '
+                           '(or threads) and each one is enhanced by a cryoten '
+                           'process that stays alive for all its volumes.')
+
+        form.addParam('useHalfMaps', params.BooleanParam, default=False,
+                      label='Enhance the half maps too?',
+                      help='Enhance the half maps associated to the input volume(s) in '
+                           'the same run, with the same workers and model load as the '
+                           'full map. The enhanced volumes get the enhanced half maps '
+                           'associated. Volumes without half maps only get the full map '
+                           'enhanced.')
+        form.addParam('computeFSC', params.BooleanParam, default=True,
+                      condition='useHalfMaps',
+                      label='Compute the FSC of the enhanced halves?',
+                      help='Fourier Shell Correlation between the enhanced half maps of '
+                           'each volume, registered as an output.')
+
+        form.addParam('useCache', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse cached results?',
+                      help='Enhanced maps are stored in a cache shared by all projects '
+                           '(CRYOTEN_CACHE_DIR, limited to CRYOTEN_CACHE_SIZE GB). '
+                           'A volume that was already enhanced with the same checkpoint '
+                           'and settings is linked from the cache without running cryoten.')
+
+        form.addSection(label='Grid')
+        form.addParam('cropMap', params.BooleanParam, default=False,
+                      label='Crop to the non-empty region?',
+                      help='Enhance only the box around the voxels above the threshold. '
+                           'The enhanced map is put back in the original box, with 0 '
+                           'outside the cropped region.')
+        form.addParam('cropThreshold', params.FloatParam, allowsNull=True,
+                      condition='cropMap',
+                      label='Threshold',
+                      help='Voxels above this value are the non-empty region. If empty, '
+                           'the mean plus 3 standard deviations of the map is used.')
+        form.addParam('cropPadding', params.FloatParam, default=10,
+                      condition='cropMap', validators=[params.GE(0)],
+                      label='Padding (A)',
+                      help='Margin added around the non-empty region.')
+        form.addParam('resampleMap', params.BooleanParam, default=False,
+                      label='Resample to the model sampling?',
+                      help='Fourier resample the maps to the sampling the network works '
+                           'at before enhancing them, and the enhanced map back to the '
+                           'sampling of the input.')
+        form.addParam('modelSampling', params.FloatParam, default=1.0,
+                      condition='resampleMap', validators=[params.GT(0)],
+                      label='Model sampling (A/px)',
+                      help='Pixel size the maps are resampled to.')
+
+        form.addSection(label='Output')
+        form.addParam('outputPrecision', params.EnumParam, default=OUTPUT_FLOAT32,
+                      choices=OUTPUT_PRECISION_CHOICES, display=params.EnumParam.DISPLAY_HLIST,
+                      label='Precision',
+                      help='Data type of the enhanced maps. float16 halves their size, '
+                           'it is read by mrcfile, ChimeraX and most recent programs.')
+        form.addParam('outputCompression', params.EnumParam, default=COMPRESSION_NONE,
+                      choices=COMPRESSION_CHOICES, display=params.EnumParam.DISPLAY_COMBO,
+                      label='Compression',
+                      help='Store the enhanced maps compressed (.mrc.gz, .mrc.bz2 or '
+                           '.mrc.zst). zstd needs the zstandard package (or Python 3.14) '
+                           'in the Scipion environment. Compressed maps take much less '
+                           'space, but many programs can not open them directly.')
+        form.addParam('cropOutput', params.BooleanParam, default=False,
+                      condition='cropMap',
+                      label='Keep only the cropped region?',
+                      help='Store only the non-empty region found by the crop, with its '
+                           'origin shifted so it still overlaps the input, instead of the '
+                           'full box with 0 out of the region.')
+
+        form.addSection(label='Tiling')
+        form.addParam('useTiles', params.BooleanParam, default=False,
+                      label='Process large maps in tiles?',
+                      help='Maps larger than the tile size are cut in overlapping cubic '
+                           'tiles that are enhanced independently (and by several GPUs '
+                           'at the same time) and blended back together. The input and '
+                           'output maps are memory mapped, so the memory needed does not '
+                           'grow with the box size.')
+        form.addParam('tileSize', params.IntParam, default=256,
+                      condition='useTiles', validators=[params.GT(0)],
+                      label='Tile size (voxels)',
+                      help='Side of the cubic tiles. Maps with all dimensions up to this '
+                           'size are processed in one go.')
+        form.addParam('autoTileSize', params.BooleanParam, default=False,
+                      condition='useTiles',
+                      label='Tune the tile size to the memory?',
+                      help='The tile size is chosen at the start of the run from the free '
+                           'memory of the GPUs (or of the host for CPU workers), and from '
+                           'the sizes that worked or ran out of memory in previous runs on '
+                           'the same host and GPU model. The tile size above is the largest '
+                           'one used. Queue runs keep the tile size above.\n'
+                           'In any case, maps or tiles that run out of memory are enhanced '
+                           'again in smaller tiles instead of failing.')
+        form.addParam('tileOverlap', params.IntParam, default=32,
+                      condition='useTiles', validators=[params.GE(0)],
+                      label='Tile overlap (voxels)',
+                      help='Voxels shared by neighbouring tiles. They are blended with a '
+                           'cosine taper to avoid seams between tiles.')
+        form.addParam('maxMemory', params.FloatParam, default=4,
+                      condition='useTiles', validators=[params.GT(0)],
+                      label='Maximum memory (GB)',
+                      help='Memory of the memory mapped maps that can be resident while '
+                           'blending the tiles before it is released.')
+
+        form.addSection(label='CPU')
+        form.addParam('cpuWorkers', params.IntParam, default=1,
+                      condition='not %s' % params.USE_GPU, validators=[params.GT(0)],
+                      label='CPU workers',
+                      help='Number of cryoten processes running at the same time when '
+                           'not using GPUs. The threads of the protocol are split among '
+                           'them and each worker is pinned to its own cores.')
+
+        form.addSection(label='Engine')
+        form.addParam('engine', params.EnumParam, default=ENGINE_EAGER,
+                      choices=ENGINE_CHOICES, display=params.EnumParam.DISPLAY_COMBO,
+                      label='Inference engine',
+                      help='eager: the model as run by eval.py, in float32.\n'
+                           'float16 (GPU) / bfloat16: mixed precision forward pass, '
+                           'bfloat16 is also faster on CPUs that support it.\n'
+                           'int8 (CPU): dynamic quantization of the linear layers of the '
+                           'transformer.\n'
+                           'torchscript / onnx: the forward pass is exported to a graph, '
+                           'run by TorchScript or ONNX Runtime (onnxruntime must be '
+                           'installed in the cryoten environment), which is also an '
+                           'efficient CPU runtime. The graph is exported the first time '
+                           'an input size is seen and cached next to cryoten.ckpt.\n'
+                           'Except int8, the engines are checked against eager the first '
+                           'time, and eager is used if they differ more than the '
+                           'tolerance.')
+        form.addParam('engineTolerance', params.FloatParam, default=0.01,
+                      condition='engine not in [%d, %d]' % (ENGINE_EAGER, ENGINE_INT8),
+                      expertLevel=params.LEVEL_ADVANCED, validators=[params.GT(0)],
+                      label='Tolerance',
+                      help='Maximum difference with the eager forward pass, relative to '
+                           'the largest value of its output.')
+
+        # Only used when the input set of volumes is still open
+        self._defineStreamingParams(form)
+
+        form.addParallelSection(threads=2, mpi=0)
+        form.addParam('volumesPerJob', params.IntParam, default=0,
+                      validators=[params.GE(0)],
+                      label='Volumes per job',
+                      help='Volumes enhanced by each enhancement step. When the steps '
+                           'are sent to the queue (QUEUE_FOR_JOBS in the host '
+                           'configuration), each step is a queue job, so a set of '
+                           'volumes is spread over the cluster in jobs of this size. '
+                           'If 0, the volumes are split among the GPUs (or CPU workers).')
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep(self.runShellCommandsStep)
-        self._insertFunctionStep(self.createOutputStep)
+        # Steps run in threads and signal handlers can only be set from the
+        # main one: stop the cryoten processes if the protocol is terminated
+        runner.installSignalHandlers()
+
+        # Steps that produce each input volume, used to know when it is done
+        self._volumeSteps = {}
+        self._nextWorkerId = 1
+        self._lastCheck = 0
+        self._finished = False
+        # An open input set is processed in streaming, see _stepsCheck
+        self._streamClosed = not self._isSetInput() or self._isInputStreamClosed()
+        self._streaming = not self._streamClosed
+
+        # Tuned once per run, continuing a run keeps its tiles
+        if self.useTiles and self.autoTileSize and not self.useQueueForSteps():
+            if not self.tunedTileSize.hasValue() or self.runMode == MODE_RESTART:
+                self.tunedTileSize.set(self._tuneTileSize())
+                self._store(self.tunedTileSize)
+                print(f"Tile size tuned to {self.tunedTileSize.get()} voxels")
+
+        outputDeps = self._insertEnhanceSteps(self._getInputWork())
+        self._insertFunctionStep(self.createOutputStep, prerequisites=outputDeps,
+                                 wait=self._streaming, needsGPU=False)
+
+    def _insertEnhanceSteps(self, work):
+        """ Insert the steps that enhance the given work units, see _getInputWork.
+        Returns the ids of the steps the output depends on. """
+        # Independent enhancement steps run at the same time, each one on
+        # its own GPU slot of the steps executor. Work units are whole
+        # maps or tiles of a map
+        enhanceSteps = []
+        if self.volumesPerJob.get():
+            groups = self._packVolumes(work, self.volumesPerJob.get())
+        else:
+            groups = self._splitInGroups(work, self._getNumberOfSteps())
+        for units in groups:
+            stepId = self._insertFunctionStep(self.enhanceStep, self._nextWorkerId, units,
+                                              prerequisites=[],
+                                              needsGPU=bool(self.getGPUIds()))
+            self._nextWorkerId += 1
+            enhanceSteps.append(stepId)
+            for volId, _, _ in units:
+                self._volumeSteps.setdefault(volId, set()).add(stepId)
+
+        # Tiled maps are put together once all their tiles are enhanced
+        outputDeps = list(enhanceSteps)
+        for volId, half in sorted({tuple(unit[:2]) for unit, _ in work if unit[2] is not None}):
+            stepId = self._insertFunctionStep(self.blendTilesStep, volId, half,
+                                              prerequisites=enhanceSteps,
+                                              needsGPU=False)
+            self._volumeSteps[volId].add(stepId)
+            outputDeps.append(stepId)
+
+        return outputDeps
+
+    def _stepsCheck(self):
+        # To enhance an input set in streaming we need to detect:
+        #   1) new volumes added to the input set
+        #   2) enhanced volumes that can be added to the output set
+        if not getattr(self, '_streaming', False):
+            return
+        self._checkNewInput()
+        self._checkNewOutput()
+
+    def _checkNewInput(self):
+        """ Insert the steps to enhance the volumes added to the input set. """
+        if self._streamClosed:
+            return
+
+        # The input set is only loaded again if it was modified since the last check
+        inputFile = self.inputVolume.get().getFileName()
+        now = time.time()
+        if os.path.getmtime(inputFile) < self._lastCheck:
+            return
+        self._lastCheck = now
+
+        # The state is read before the items, so no volume is missed when it closes
+        inputSet = self._loadInputSet()
+        self._streamClosed = inputSet.isStreamClosed()
+        newIds = inputSet.getIdSet() - self._volumeSteps.keys()
+        inputSet.close()
+
+        if newIds:
+            self.info(f"{len(newIds)} new volumes to enhance.")
+            outputDeps = self._insertEnhanceSteps(self._getInputWork(newIds))
+            self._getFirstJoinStep().addPrerequisites(*outputDeps)
+            self.updateSteps()
+
+    def _checkNewOutput(self):
+        """ Add the enhanced volumes to the output set, closing it (and
+        releasing createOutputStep) once the input is closed and all its
+        volumes are enhanced. """
+        if self._finished:
+            return
+
+        outputSet = getattr(self, 'outputVolumes', None)
+        registered = outputSet.getIdSet() if outputSet is not None else set()
+        done = {volId for volId, steps in self._volumeSteps.items()
+                if all(self._steps[stepId - 1].isFinished() for stepId in steps)}
+        newDone = done - registered
+
+        self._finished = self._streamClosed and len(done) == len(self._volumeSteps)
+        if newDone or self._finished:
+            self._updateOutputVolumes(newDone, Set.STREAM_CLOSED if self._finished
+                                      else Set.STREAM_OPEN)
+        elif len(done) == len(self._volumeSteps):
+            # Nothing left to do until new volumes arrive
+            self._streamingSleepOnWait()
+
+        if self._finished:
+            outputStep = self._getFirstJoinStep()
+            if outputStep.isWaiting():
+                outputStep.setStatus(STATUS_NEW)
 
-    def get_conda_path(self):
-        """Determine the path to the conda.sh script dynamically."""
+    def enhanceStep(self, workerId, units):
+        """ Enhance the given work units with one worker per GPU assigned to this step,
+        or with a queue job when the steps are sent to the queue.
+        Errors fail the step, the units already enhanced are kept for a resume. """
+        cryotenPath = self._getBackend().getWorkingPath()
         try:
-            result = subprocess.run(['conda', 'info', '--base'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            base_path = result.stdout.decode('utf-8').strip()
-            if result.returncode == 0 and base_path:
-                return os.path.join(base_path, 'etc', 'profile.d', 'conda.sh')
+            if self.useQueueForSteps():
+                stats = [self._submitWorker(workerId, cryotenPath, units)]
             else:
-                raise Exception(f"Failed to determine conda base path: {result.stderr.decode('utf-8')}")
-        except Exception as e:
-            raise Exception(f"An error occurred while determining conda path: {e}")
-
-    def runShellCommandsStep(self):
-        def run_command(command):
-            """Run a shell command and handle any errors."""
-            process = subprocess.run(command, shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-            stdout = process.stdout.decode('utf-8')
-            stderr = process.stderr.decode('utf-8')
-            if process.returncode != 0:
-                raise Exception(f"Command '{command}' failed with error: {stderr}")
-            return stdout, stderr
+                stats = self._runWorkers(workerId, cryotenPath, units)
+        except BaseException:
+            # Input tiles left in shared memory use the RAM of the node
+            mrcio.removeSharedFiles(self._getTilePath(volId, half, tileIndex, '_in')
+                                    for volId, half, tileIndex in units
+                                    if tileIndex is not None)
+            raise
 
-        try:
-            # Get the file path of the input volume
-            inputFilePath = self.inputVolume.get().getFileName()
+        statsFile = self._getExtraPath(f"worker_stats_{workerId:02d}.json")
+        with open(statsFile, 'w') as f:
+            json.dump(stats, f, indent=2)
 
-            print(f"Input file path: {inputFilePath}")
+    def _runWorkers(self, workerId, cryotenPath, units):
+        """ Split units among one worker per GPU of the executor slot running
+        this step (a CPU worker if none). Returns the stats of the workers. """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+        devices = [str(gpu) for gpu in self._stepsExecutor.getGpuList()] if self.usesGpu() else []
+        devices = devices or [None]
+        work = [w for w in self._getInputWork({u[0] for u in units}) if w[0] in units]
+        groups = self._splitInGroups(work, len(devices))
 
-            # Get the base path of the Scipion project
-            projectPath = self.getProject().getPath()
+        # The workers of the step are stopped as soon as one of them fails,
+        # and the ones still planning their jobs are not started
+        workers, cancelled = [], threading.Event()
+        with ThreadPoolExecutor(len(devices)) as pool:
+            futures = [pool.submit(self._runWorker, workerId, cryotenPath, device, group,
+                                   workers, cancelled)
+                       for device, group in zip(devices, groups)]
+            wait(futures, return_when=FIRST_EXCEPTION)
+            # Failed before any worker was stopped, so on their own
+            failed = [future for future in futures
+                      if future.done() and future.exception() is not None]
+            if failed:
+                cancelled.set()
+                for cryoten in list(workers):
+                    cryoten.terminate()
+                # Once the other workers are stopped
+                pool.shutdown()
+                raise failed[0].exception()
+            return [future.result() for future in futures]
 
-            # Construct the full path
-            fullInputFilePath = os.path.join(projectPath, inputFilePath)
+    def _runWorker(self, workerId, cryotenPath, device, units, workers=None, cancelled=None):
+        """ Enhance units with a single persistent worker on device (None for CPU).
+        Maps found in the result cache, or enhanced by an interrupted run,
+        are reused and the worker is only started if something is left to
+        compute. The worker is added to workers while it runs, so it can be
+        cancelled, and it is not started once the cancelled event is set. """
+        worker = f"Worker {workerId} ({'GPU %s' % device if device is not None else 'CPU'})"
+        timer = metrics.PhaseTimer(gpu=device)
+        t0 = time.time()
+        stats, volumes, pending = self._planJobs(worker, units, timer)
+        if not pending:
+            stats['seconds'] = time.time() - t0
+            return stats
 
-            print(f"Full input file path: {fullInputFilePath}")
+        # The environment of cryoten_env is resolved once by the plugin, so the
+        # worker is launched directly with its interpreter, without a shell.
+        # An empty CUDA_VISIBLE_DEVICES hides all GPUs from CPU workers
+        with timer.measure('environment'):
+            backend = self._getBackend()
+            command = backend.getCommand()
+            env = backend.getEnviron('' if device is None else device)
+            env.update(self._getWorkerEnviron(workerId, device))
+        print(f"Running command: {' '.join(command)}")
 
-            # Determine the conda path dynamically
-            condaPath = self.get_conda_path()
+        from cryoten import batch, tuning
+        from cryoten.worker import CryotenWorker
+        cryoten = CryotenWorker(command, env=env, cwd=cryotenPath, name=worker)
+        if workers is not None:
+            workers.append(cryoten)
+        # Checked once in workers: either it is terminated, so it does not
+        # start, or the cancellation is seen here
+        if cancelled is not None and cancelled.is_set():
+            raise RuntimeError(f"{worker} cancelled after another worker failed")
+        stats['startupSeconds'] = batch.runJobs(
+            cryoten, pending, timer, lambda job: self._finishJob(volumes, job, timer),
+            dict(self._getTuningSettings(), key=tuning.getMachineKey(device)))
 
-            # Get the Scipion base path from the environment variable
-            scipion_base_path = os.getenv('SCIPION_HOME')
+        stats['seconds'] = time.time() - t0
+        stats['phases'] = timer.phases
+        return stats
 
-            # Verify the Scipion base path
-            if not scipion_base_path or not os.path.isdir(scipion_base_path):
-                raise Exception(f"Scipion base path does not exist or is not set: {scipion_base_path}")
+    def _submitWorker(self, workerId, cryotenPath, units):
+        """ Enhance units with a queue job running a single persistent worker
+        (see cryoten.batch), on the GPU, or the cores, the queue gives it. """
+        worker = f"Queue job {workerId}"
+        timer = metrics.PhaseTimer()
+        t0 = time.time()
+        # Tiles go through the shared file system, the job may run elsewhere
+        stats, volumes, pending = self._planJobs(worker, units, timer, sharedTiles=False)
+        if not pending:
+            stats['seconds'] = time.time() - t0
+            return stats
 
-            # Print the Scipion base path for verification
-            print(f"Scipion base path: {scipion_base_path}")
+        with timer.measure('environment'):
+            backend = self._getBackend()
+            command = backend.getCommand()
+            environ = backend.getJobEnviron()
+            environ.update(self._getEngineEnviron())
+            if not self.usesGpu():
+                environ.update(self._getWorkerEnviron(workerId, None), CUDA_VISIBLE_DEVICES='')
+                # The cores are chosen by the queue
+                environ.pop('CRYOTEN_CPU_CORES', None)
+        from cryoten import batch
+        queuePath = self._getExtraPath('queue')
+        os.makedirs(queuePath, exist_ok=True)
+        batchPath = os.path.abspath(os.path.join(queuePath, f"batch_{workerId:02d}.json"))
+        batchFile = batch.writeBatch(batchPath, worker, command, cryotenPath, environ, pending,
+                                     self._getTuningSettings())
+        cleanPath(batchFile['result'])
 
-            # Construct the Cryoten path based on the Scipion base path
-            cryotenPath = os.path.join(scipion_base_path, 'software/em/cryoten-1.0.0/cryoten')
+        # The job runs in Scipion, the environment of the backend is in the batch
+        self.runJob(pw.PYTHON, f'-m cryoten.batch "{batchPath}"',
+                    numberOfThreads=self.numberOfThreads.get(), env=Environ(os.environ))
 
-            # Verify the Cryoten path
-            if not os.path.isdir(cryotenPath):
-                raise Exception(f"Cryoten path does not exist: {cryotenPath}")
+        result = None
+        if os.path.exists(batchFile['result']):
+            with open(batchFile['result']) as f:
+                result = json.load(f)
 
-            # Print the Cryoten path for verification
-            print(f"Cryoten path: {cryotenPath}")
+        # Whatever the job managed to enhance is kept, for a resume. Without
+        # the result it is not known which maps were backed off to tiles
+        missing = []
+        for job in pending:
+            try:
+                mrcio.checkMap(job['output'])
+            except Exception as e:
+                missing.append(str(e))
+                continue
+            if result is None or job['output'] in result['backoff']:
+                job = dict(job, backoff=True)
+            self._finishJob(volumes, job, timer)
+        if missing or result is None:
+            raise Exception(f"{worker} did not finish, {len(missing)} of {len(pending)} "
+                            f"maps or tiles missing, see {self._getLogsPath()}:\n"
+                            + '\n'.join(missing[:10]))
 
-            # Get the run directory name dynamically
-            runPath = self._getPath()
-            runDirName = os.path.basename(runPath)
-            extraPath = os.path.join(projectPath, 'Runs', runDirName, 'extra')
-            print(f"Extra path: {extraPath}")
+        for phase, phaseStats in result['phases'].items():
+            timer.add(phase, phaseStats['wall'], phaseStats['cpu'], phaseStats['peakRss'],
+                      phaseStats['gpuPeakBytes'])
+        stats['startupSeconds'] = result['startupSeconds']
+        stats['seconds'] = time.time() - t0
+        stats['phases'] = timer.phases
+        return stats
 
-            # Construct the output file path dynamically based on the extraPath
-            inputFileName = os.path.basename(inputFilePath)
-            print(f"Input file name: {inputFileName}")
-            outputFileName = os.path.splitext(inputFileName)[0] + '.mrc'
-            outputFilePath = os.path.join(extraPath, outputFileName)
+    def _planJobs(self, worker, units, timer, sharedTiles=True):
+        """ Jobs of a worker for units, see cryoten.batch, skipping the maps
+        found in the result cache or enhanced by an interrupted run.
+        Returns the stats of the worker, the volumes by id and the jobs. """
+        stats = {'worker': worker, 'volumes': 0, 'tiles': 0, 'bytes': 0, 'seconds': 0.0,
+                 'cacheHits': 0, 'cacheMisses': 0, 'resumed': 0}
+        pending = []
+        volumes = {vol.getObjId(): vol for vol in self._iterInputVolumes({u[0] for u in units})}
+        for volId, half, tileIndex in units:
+            vol = volumes[volId]
+            fullInputFilePath = self._getInputFilePath(vol, half)
+            # The map of an interrupted run is kept, the cache is only looked up without it
+            done = self._isDone(vol, half, None, self._getOutputFilePath(vol, half))
+            cacheKey, cached = (None, False) if done else self._lookupCache(vol, half)
 
-            # Get GPU list from parameters
-            forGpu = 'export CUDA_VISIBLE_DEVICES={}'.format(self.getGPUIds()[0])
+            if tileIndex is None:
+                print(f"Full input file path: {fullInputFilePath}")
+                stats['volumes'] += 1
+                stats['bytes'] += os.path.getsize(fullInputFilePath)
+                if done:
+                    print(f"{worker} kept the map enhanced by a previous run "
+                          f"for {fullInputFilePath}")
+                    stats['resumed'] += 1
+                    continue
+                if cached:
+                    print(f"{worker} reused the cached result for {fullInputFilePath}")
+                    stats['cacheHits'] += 1
+                    continue
+                if cacheKey is not None:
+                    stats['cacheMisses'] += 1
+                with timer.measure('gridMapping'):
+                    workInputPath = self._prepareInput(vol, half)
+                pending.append({'input': workInputPath, 'cacheKey': cacheKey,
+                                'output': self._getWorkOutputPath(vol, half),
+                                'unit': [volId, half, None]})
 
-            # Construct the command
-            command = f"""
-                source {condaPath} && \
-                conda activate cryoten_env && \
-                {forGpu} && \
-                cd {cryotenPath} && \
-                python eval.py {fullInputFilePath} {outputFilePath}
-            """
-            print(f"Running command: {command}")
+            elif not (done or cached):  # Done or cached tiled maps are counted when blending
+                corner, tileShape = self._getVolumeTiles(vol, half)[tileIndex]
+                stats['tiles'] += 1
+                tileBytes = 4 * tileShape[0] * tileShape[1] * tileShape[2]
+                stats['bytes'] += tileBytes
+                if self._isDone(vol, half, tileIndex,
+                                self._getTilePath(volId, half, tileIndex)):
+                    stats['resumed'] += 1
+                    continue
+                with timer.measure('gridMapping'):
+                    workInputPath = self._prepareInput(vol, half)
+                # Input tiles only live while enhanced, in shared memory if possible
+                tileInputPath = self._getTilePath(volId, half, tileIndex, '_in')
+                if sharedTiles:
+                    tileInputPath = mrcio.getSharedPath(tileInputPath, tileBytes)
+                pending.append({'input': tileInputPath,
+                                'output': self._getTilePath(volId, half, tileIndex),
+                                'tile': [workInputPath, list(corner), list(tileShape)],
+                                'unit': [volId, half, tileIndex]})
+        return stats, volumes, pending
 
+    def _finishJob(self, volumes, job, timer):
+        """ Record an enhanced map or tile, once checked. Whole maps are mapped
+        back from the working grid and stored in the result cache, unless they
+        ran out of memory and were enhanced in tiles instead (see cryoten.batch),
+        which does not give the map of the settings in the cache key. """
+        volId, half, tileIndex = job['unit']
+        vol = volumes[volId]
+        if tileIndex is not None:
+            self._setDone(vol, half, tileIndex, job['output'])
+            return
 
-            # Execute the command and log output and error messages
-            stdout, stderr = run_command(command)
-            print(f"Command output: {stdout}")
-            print(f"Command error: {stderr}")
+        with timer.measure('gridMapping'):
+            self._restoreOutput(vol, half)
+        outputFilePath = self._getOutputFilePath(vol, half)
+        self._setDone(vol, half, None, outputFilePath)
+        if job.get('cacheKey') is not None and not job.get('backoff'):
+            Plugin.getResultCache().put(job['cacheKey'], outputFilePath)
 
-            # Verify the output file
-            if not os.path.isfile(outputFilePath):
-                raise Exception(f"Output file was not created: {outputFilePath}")
+    def blendTilesStep(self, volId, half=FULL_MAP):
+        """ Blend the enhanced tiles of a map into its output map. """
+        t0 = time.time()
+        vol = self._getInputVolume(volId)
+        fullInputFilePath = self._getInputFilePath(vol, half)
+        mapName = f"volume {volId}" + (f", half {half}" if half != FULL_MAP else '')
+        stats = {'worker': f"Tile blending ({mapName})", 'volumes': 1, 'tiles': 0,
+                 'bytes': os.path.getsize(fullInputFilePath), 'cacheHits': 0, 'cacheMisses': 0}
 
-            # Save the output file path for the next step
-            self.outputFilePath = String(outputFilePath)
-            self._store()
-            print(f"Output file path set to: {self.outputFilePath}")
+        outputFilePath = self._getOutputFilePath(vol, half)
+        done = self._isDone(vol, half, None, outputFilePath)
+        cacheKey, cached = (None, False) if done else self._lookupCache(vol, half)
+        if done:
+            stats['resumed'] = 1
+        elif cached:
+            stats['cacheHits'] += 1
+        else:
+            tiles = self._getVolumeTiles(vol, half)
+            tilePaths = [self._getTilePath(volId, half, i) for i in range(len(tiles))]
+            from cryoten import tiling
+            timer = metrics.PhaseTimer()
+            with timer.measure('outputWrite'):
+                tiling.blendTiles(self._prepareInput(vol, half),
+                                  self._getWorkOutputPath(vol, half), tiles, tilePaths,
+                                  self.tileOverlap.get(), self.maxMemory.get() * 1024 ** 3,
+                                  self._getTilesPath(volId, half, 'weights.dat'))
+            with timer.measure('gridMapping'):
+                self._restoreOutput(vol, half)
+            self._setDone(vol, half, None, outputFilePath)
+            stats['phases'] = timer.phases
+            stats['tiles'] = len(tiles)
+            if cacheKey is not None:
+                stats['cacheMisses'] += 1
+                Plugin.getResultCache().put(cacheKey, outputFilePath)
+        tilesPath = self._getTilesPath(volId, half)
+        cleanPath(tilesPath)
+        mrcio.removeSharedFolder(tilesPath)
 
-        except Exception as e:
-            print(f"An error occurred: {e}")
+        stats['seconds'] = time.time() - t0
+        with open(self._getExtraPath(f"worker_stats_blend_{volId:06d}_{half}.json"), 'w') as f:
+            json.dump([stats], f, indent=2)
 
     def createOutputStep(self):
-        """Create output volume and register it in Scipion."""
-        print(f"Output file path set to: {self.outputFilePath}")
-        if not self.outputFilePath:
-            raise RuntimeError("Output file path is not set. Ensure runShellCommandsStep has been executed successfully.")
+        """Create output volume(s) and register them in Scipion."""
+        workerStats = self._loadWorkerStats()
+        self.cacheHits.set(sum(stats.get('cacheHits', 0) for stats in workerStats))
+        self.cacheMisses.set(sum(stats.get('cacheMisses', 0) for stats in workerStats))
+        self._store(self.cacheHits, self.cacheMisses)
 
-        outputVolume = Volume()
-        outputVolume.setFileName(self.outputFilePath)
+        timer = metrics.PhaseTimer()
+        with timer.measure('registration'):
+            self._registerOutput()
+            if self.useHalfMaps and self.computeFSC:
+                self._registerFSCs()
+
+        # Time spent in each phase by all the workers
+        phases = metrics.mergePhases([stats.get('phases', {}) for stats in workerStats]
+                                     + [timer.phases])
+        with open(self._getMetricsFile(), 'w') as f:
+            json.dump({'phases': phases, 'workers': workerStats}, f, indent=2)
 
-        # Copy the voxel size from the input volume to the output volume
-        voxelSize = self.inputVolume.get().getSamplingRate()
-        outputVolume.setSamplingRate(voxelSize)
+    def _registerOutput(self):
+        """ Define the enhanced volume, or the set of enhanced volumes, as output. """
+        if self._isSetInput():
+            # Volumes not registered yet while streaming are added now
+            self._updateOutputVolumes({vol.getObjId() for vol in self._iterInputVolumes()},
+                                      Set.STREAM_CLOSED)
+            return
+
+        outputVolume = self._createOutputVolume(self.inputVolume.get())
+
+        # Save the output file path
+        self.outputFilePath = String(outputVolume.getFileName())
+        print(f"Output file path set to: {self.outputFilePath}")
 
         self._defineOutputs(outputVolume=outputVolume)
         self._defineSourceRelation(self.inputVolume, outputVolume)
+        self._store()
+
+    def _updateOutputVolumes(self, volIds, streamMode):
+        """ Register the enhanced volumes of the given input volumes in the
+        output set, creating it the first time. """
+        outputSet = getattr(self, 'outputVolumes', None)
+        firstTime = outputSet is None
+        if firstTime:
+            outputSet = self._createSetOfVolumes()
+            outputSet.setSamplingRate(self.inputVolume.get().getSamplingRate())
+        else:
+            outputSet.enableAppend()
+            volIds = set(volIds) - outputSet.getIdSet()
+
+        for vol in self._iterInputVolumes(volIds):
+            outputVolume = self._createOutputVolume(vol)
+            outputVolume.setObjId(vol.getObjId())
+            outputSet.append(outputVolume)
+
+        self._updateOutputSet('outputVolumes', outputSet, streamMode)
+        if firstTime:
+            self._defineSourceRelation(self.inputVolume, outputSet)
+
+    def _createOutputVolume(self, vol):
+        """ Enhanced volume of an input volume, with its enhanced half maps
+        when they were processed too. """
+        outputFilePaths = [self._getOutputFilePath(vol, half) for half in self._getMaps(vol)]
+        for outputFilePath in outputFilePaths:
+            if not os.path.isfile(outputFilePath):
+                raise RuntimeError(f"Output file was not created: {outputFilePath}. "
+                                   f"Ensure enhanceStep has been executed successfully.")
+
+        outputVolume = Volume()
+        outputVolume.setFileName(outputFilePaths[0])
+        # Copy the voxel size and origin from the input volume to the output volume
+        outputVolume.setSamplingRate(vol.getSamplingRate())
+        origin = Transform()
+        shifts = vol.getShiftsFromOrigin()
+        if self._cropsOutput():
+            from cryoten import grid
+            transform = self._getGridTransform(vol)
+            shifts = [s + c - o for s, c, o in zip(shifts, grid.getCropOrigin(transform),
+                                                   transform['origin'])]
+        origin.setShifts(*shifts)
+        outputVolume.setOrigin(origin)
+        if len(outputFilePaths) > 1:
+            outputVolume.setHalfMaps(outputFilePaths[1:])
+        return outputVolume
+
+    def _registerFSCs(self):
+        """ FSC between the enhanced half maps of each volume. """
+        from cryoten import fsc
+        fscs = []
+        for vol in self._iterInputVolumes():
+            if len(self._getMaps(vol)) < 3:
+                continue
+            frequencies, values = fsc.computeFSC(self._getOutputFilePath(vol, HALF_MAP_1),
+                                                 self._getOutputFilePath(vol, HALF_MAP_2),
+                                                 vol.getSamplingRate())
+            fscObj = FSC(objLabel=f"Enhanced half maps FSC ({vol.getObjId()})")
+            fscObj.setData(frequencies.tolist(), values.tolist())
+            fscs.append(fscObj)
+
+        if not fscs:
+            return
+        if self._isSetInput():
+            outputFSCs = self._createSetOfFSCs()
+            for fscObj in fscs:
+                outputFSCs.append(fscObj)
+            self._defineOutputs(outputFSCs=outputFSCs)
+            self._defineSourceRelation(self.inputVolume, outputFSCs)
+        else:
+            self._defineOutputs(outputFSC=fscs[0])
+            self._defineSourceRelation(self.inputVolume, fscs[0])
+
+    # --------------------------- UTILS functions ------------------------------
+    def _isSetInput(self):
+        return isinstance(self.inputVolume.get(), SetOfVolumes)
+
+    def _loadInputSet(self):
+        """ Load the input set from its file, to see the volumes added in
+        streaming. The caller should close it as soon as possible. """
+        inputSet = self.inputVolume.get()
+        updatedSet = inputSet.getClass()(filename=inputSet.getFileName())
+        updatedSet.loadAllProperties()
+        return updatedSet
+
+    def _isInputStreamClosed(self):
+        inputSet = self._loadInputSet()
+        streamClosed = inputSet.isStreamClosed()
+        inputSet.close()
+        return streamClosed
+
+    def _iterInputVolumes(self, volIds=None):
+        """ Iterate over the input volumes, whether the input is a set or not.
+        If volIds is given, only those volumes of the set are returned. """
+        if self._isSetInput():
+            inputSet = self._loadInputSet()
+            try:
+                for vol in inputSet.iterItems(orderBy='id'):
+                    if volIds is None or vol.getObjId() in volIds:
+                        yield vol.clone()
+            finally:
+                inputSet.close()
+        else:
+            yield self.inputVolume.get()
+
+    def _getInputVolume(self, volId):
+        return next(self._iterInputVolumes({volId}))
+
+    def _getMaps(self, vol):
+        """ Maps of vol to enhance: the volume and, if requested, its half maps. """
+        if self.useHalfMaps and vol.hasHalfMaps():
+            return [FULL_MAP, HALF_MAP_1, HALF_MAP_2]
+        return [FULL_MAP]
+
+    def _getInputFilePath(self, vol, half=FULL_MAP):
+        # Get the base path of the Scipion project
+        projectPath = self.getProject().getPath()
+        fileName = vol.getFileName() if half == FULL_MAP else vol.getHalfMaps(asList=True)[half - 1]
+        # Drop the Scipion format suffix (e.g. map.mrc:mrc)
+        return os.path.join(projectPath, fileName.split(':')[0])
+
+    def _getOutputFilePath(self, vol, half=FULL_MAP):
+        """ Output map inside extra/. Volumes from a set get their id appended
+        since different items may share the same file name. """
+        inputFileName = os.path.basename(vol.getFileName())
+        baseName = os.path.splitext(inputFileName)[0]
+        if self._isSetInput():
+            baseName += f"_{vol.getObjId():03d}"
+        if half != FULL_MAP:
+            baseName += f"_half{half}"
+        suffix = '.mrc' + COMPRESSION_SUFFIXES[self.outputCompression.get()]
+        return os.path.abspath(self._getExtraPath(baseName + suffix))
+
+    def _getInputWork(self, volIds=None):
+        """ List of (unit, bytes) used to balance the work among workers. A work
+        unit is [volId, half, None] for a whole map or [volId, half, tileIndex],
+        where half is FULL_MAP, HALF_MAP_1 or HALF_MAP_2. """
+        work = []
+        for vol in self._iterInputVolumes(volIds):
+            for half in self._getMaps(vol):
+                tiles = self._getVolumeTiles(vol, half)
+                if tiles:
+                    work.extend(([vol.getObjId(), half, i], 4 * shape[0] * shape[1] * shape[2])
+                                for i, (_, shape) in enumerate(tiles))
+                else:
+                    work.append(([vol.getObjId(), half, None],
+                                 os.path.getsize(self._getInputFilePath(vol, half))))
+        return work
+
+    def _getVolumeTiles(self, vol, half=FULL_MAP):
+        """ Tiles of a map as (corner, shape), empty if it is processed in one go. """
+        if not self.useTiles:
+            return []
+        if self._usesGrid():
+            shape = tuple(self._getGridTransform(vol, half)['workShape'])
+        else:
+            shape = mrcio.readHeader(self._getInputFilePath(vol, half)).shape
+        if max(shape) <= self._getTileSize():
+            return []
+        from cryoten import tiling
+        return tiling.getTiles(shape, self._getTileSize(), self.tileOverlap.get())
+
+    def _getTileSize(self):
+        """ Tile size of the form, or the one tuned at the start of the run. """
+        if self.autoTileSize and self.tunedTileSize.hasValue():
+            return self.tunedTileSize.get()
+        return self.tileSize.get()
+
+    def _tuneTileSize(self):
+        """ Largest tile that fits in the free memory of every GPU, or in the
+        share of the host memory of each CPU worker, see cryoten.tuning. """
+        from cryoten import tuning
+        from cryoten.preflight import HOST_BYTES_PER_VOXEL
+        tuner = Plugin.getTuner()
+        maxSize = self.tileSize.get()
+        minSize = min(maxSize, max(tuning.MIN_TILE_SIZE, 2 * self.tileOverlap.get() + 8))
+        sizes = []
+        for gpu in self.getGPUIds() or [None]:
+            freeBytes = tuning.getFreeMemory(gpu)
+            if gpu is None:
+                freeBytes = freeBytes and freeBytes // self.cpuWorkers.get()
+            bytesPerVoxel = HOST_BYTES_PER_VOXEL if gpu is None else tuning.GPU_BYTES_PER_VOXEL
+            sizes.append(tuner.getTileSize(tuning.getMachineKey(gpu), freeBytes,
+                                           bytesPerVoxel, minSize, maxSize))
+        return min(sizes)
+
+    def _getTuningSettings(self):
+        """ Settings to enhance again in smaller tiles the maps that run out
+        of memory, see cryoten.batch.runJobs. """
+        return {'file': Plugin.getTuner().path, 'overlap': self.tileOverlap.get(),
+                'maxMemory': self.maxMemory.get() * 1024 ** 3}
+
+    def _getTilesPath(self, volId, half, *paths):
+        """ Folder for the tiles of a map until they are blended. It is in
+        extra/, not tmp/, so the enhanced tiles survive an interrupted run. """
+        folder = f"tiles_{volId:06d}" + (f"_half{half}" if half != FULL_MAP else '')
+        tilesPath = os.path.abspath(self._getExtraPath(folder))
+        os.makedirs(tilesPath, exist_ok=True)
+        return os.path.join(tilesPath, *paths)
+
+    def _getTilePath(self, volId, half, tileIndex, suffix=''):
+        return self._getTilesPath(volId, half, f"tile_{tileIndex:05d}{suffix}.mrc")
+
+    def _getProgressPath(self, volId, half, tileIndex=None):
+        """ Record of an enhanced map, or tile of a map. """
+        name = f"{volId:06d}" + (f"_half{half}" if half != FULL_MAP else '')
+        if tileIndex is not None:
+            name += f"_tile{tileIndex:05d}"
+        progressPath = self._getExtraPath('progress')
+        os.makedirs(progressPath, exist_ok=True)
+        return os.path.join(progressPath, name + '.json')
+
+    def _setDone(self, vol, half, tileIndex, outputPath):
+        """ Record that the map or tile in outputPath is enhanced and checked. """
+        record = {'output': outputPath, 'bytes': os.path.getsize(outputPath),
+                  'mtime': os.path.getmtime(outputPath),
+                  'settings': self._getInferenceSettings(vol, half)}
+        writeJson(self._getProgressPath(vol.getObjId(), half, tileIndex), record)
+
+    def _isDone(self, vol, half, tileIndex, outputPath):
+        """ Whether a previous run of the protocol enhanced the map or tile with
+        the same settings, and its output is still there unchanged. """
+        progressPath = self._getProgressPath(vol.getObjId(), half, tileIndex)
+        if not os.path.exists(progressPath):
+            return False
+        with open(progressPath) as f:
+            record = json.load(f)
+        try:
+            mrcio.checkMap(outputPath)
+        except Exception as e:
+            print(f"Enhancing again {outputPath}: {e}")
+            return False
+        return (record['output'] == outputPath and
+                record['bytes'] == os.path.getsize(outputPath) and
+                record['mtime'] == os.path.getmtime(outputPath) and
+                record['settings'] == self._getInferenceSettings(vol, half))
+
+    def _usesGrid(self):
+        return bool(self.cropMap or self.resampleMap)
+
+    def _getGridPath(self, volId, half, *paths):
+        """ Scratch folder for a map on the working grid of the network. """
+        folder = f"grid_{volId:06d}" + (f"_half{half}" if half != FULL_MAP else '')
+        gridPath = os.path.abspath(self._getTmpPath(folder))
+        os.makedirs(gridPath, exist_ok=True)
+        return os.path.join(gridPath, *paths)
+
+    def _getGridTransform(self, vol, half=FULL_MAP):
+        """ Crop and resampling of a map to the working grid, see grid.getTransform.
+        Saved in extra/ once computed, so all the steps use the same one. """
+        from cryoten import grid
+        suffix = f"_half{half}" if half != FULL_MAP else ''
+        transformPath = self._getExtraPath(f"grid_{vol.getObjId():06d}{suffix}.json")
+        with self._getMapLock(vol, half):
+            if not os.path.exists(transformPath):
+                inputFilePath = self._getInputFilePath(vol, half)
+                padding = 0
+                if self.cropMap:
+                    voxelSize = min(mrcio.readHeader(inputFilePath).voxelSize)
+                    padding = int(round(self.cropPadding.get() / voxelSize))
+                # Cropped outputs of the half maps share the box of the full map
+                region = None
+                if half != FULL_MAP and self._cropsOutput():
+                    region = self._getGridTransform(vol)['region']
+                grid.saveTransform(transformPath, grid.getTransform(
+                    inputFilePath,
+                    self.modelSampling.get() if self.resampleMap else None,
+                    self.cropThreshold.get() if self.cropMap else None,
+                    padding, crop=bool(self.cropMap), region=region))
+            return grid.loadTransform(transformPath)
+
+    def _prepareInput(self, vol, half=FULL_MAP):
+        """ Map the workers enhance: the input map, or the map on the working
+        grid if it is cropped or resampled, written by the first one to need it. """
+        if not self._usesGrid():
+            return self._getInputFilePath(vol, half)
+        from cryoten import grid
+        workInputPath = self._getGridPath(vol.getObjId(), half, 'input.mrc')
+        transform = self._getGridTransform(vol, half)
+        with self._getMapLock(vol, half):
+            if not os.path.exists(workInputPath):
+                with atomicPath(workInputPath) as tmpPath:
+                    grid.prepareMap(self._getInputFilePath(vol, half), tmpPath, transform)
+        return workInputPath
+
+    def _compactsOutput(self):
+        return (self.outputPrecision.get() != OUTPUT_FLOAT32
+                or self.outputCompression.get() != COMPRESSION_NONE)
+
+    def _cropsOutput(self):
+        return bool(self.cropMap and self.cropOutput)
+
+    def _getWorkOutputPath(self, vol, half=FULL_MAP):
+        """ Enhanced map as written by the workers. """
+        if not self._usesGrid() and not self._compactsOutput():
+            return self._getOutputFilePath(vol, half)
+        return self._getGridPath(vol.getObjId(), half, 'enhanced.mrc')
+
+    def _restoreOutput(self, vol, half=FULL_MAP):
+        """ Map the enhanced map back to the box, sampling and origin of the
+        input, and store it with the precision and compression requested. """
+        workOutputPath = self._getWorkOutputPath(vol, half)
+        outputFilePath = self._getOutputFilePath(vol, half)
+        if workOutputPath == outputFilePath:
+            return
+        if self._usesGrid():
+            from cryoten import grid
+            restoredPath = outputFilePath
+            if self._compactsOutput():
+                restoredPath = self._getGridPath(vol.getObjId(), half, 'restored.mrc')
+            grid.restoreMap(workOutputPath, restoredPath, self._getGridTransform(vol, half),
+                            crop=self._cropsOutput())
+            workOutputPath = restoredPath
+        if self._compactsOutput():
+            dtype = OUTPUT_PRECISION_CHOICES[self.outputPrecision.get()]
+            mrcio.writeMap(workOutputPath, outputFilePath, dtype)
+        cleanPath(self._getGridPath(vol.getObjId(), half))
+
+    def _getMapLock(self, vol, half=FULL_MAP):
+        """ Lock of a map, for the work done once per map by any of the workers. """
+        with self._mapLocksLock:
+            return self._mapLocks.setdefault((vol.getObjId(), half), threading.RLock())
+
+    def _lookupCache(self, vol, half=FULL_MAP):
+        """ Result cache key of a map and whether its enhanced map was placed in
+        extra/ from the cache, or (None, False) if the cache is not used.
+        Memoized, since the tiles of a map may go to several workers. """
+        if not self.useCache:
+            return None, False
+
+        mapKey = (vol.getObjId(), half)
+        with self._getMapLock(vol, half):
+            if mapKey not in self._cacheLookups:
+                cache = Plugin.getResultCache()
+                cacheKey = cache.makeKey(self._getInputFilePath(vol, half),
+                                         self._getBackend().getModelPath(),
+                                         self._getInferenceSettings(vol, half))
+                self._cacheLookups[mapKey] = (cacheKey,
+                                              cache.get(cacheKey,
+                                                        self._getOutputFilePath(vol, half)))
+            return self._cacheLookups[mapKey]
+
+    def _getFirstJoinStep(self):
+        for step in self._steps:
+            if step.funcName == 'createOutputStep':
+                return step
+        return None
+
+    def _getNumberOfSteps(self):
+        """ One step per GPU slot of the steps executor, or one per
+        CPU worker when not using GPUs. """
+        gpus = self.getGPUIds()
+        if not gpus:
+            return self.cpuWorkers.get()
+        return min(len(gpus), max(1, self.numberOfThreads.get() - 1))
+
+    def _getEngineEnviron(self):
+        """ Inference engine of the workers, see scripts/cryoten_worker.py. """
+        return {
+            'CRYOTEN_ENGINE': ENGINE_CHOICES[self.engine.get()],
+            'CRYOTEN_ENGINE_TOLERANCE': str(self.engineTolerance.get()),
+            'CRYOTEN_CHECKPOINT': self._getBackend().getModelPath(),
+            'CRYOTEN_ENGINE_DIR': Plugin.getEngineDir(),
+        }
+
+    def _getWorkerEnviron(self, workerId, device):
+        """ Engine and thread settings of a worker. CPU workers share the
+        threads of the protocol and each one is pinned to its own cores. """
+        environ = self._getEngineEnviron()
+        if device is not None:
+            return environ
+
+        threads = max(1, self.numberOfThreads.get() // self.cpuWorkers.get())
+        environ.update({
+            'CRYOTEN_INTRA_OP_THREADS': str(threads),
+            'CRYOTEN_INTER_OP_THREADS': '1',
+            'OMP_NUM_THREADS': str(threads),
+            'MKL_NUM_THREADS': str(threads),
+            'OMP_PROC_BIND': 'close',
+            'OMP_PLACES': 'cores',
+        })
+
+        # Cores allowed to this process (e.g. by the queue system)
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+            first = ((workerId - 1) * threads) % len(cores)
+            workerCores = (cores + cores)[first:first + min(threads, len(cores))]
+            environ['CRYOTEN_CPU_CORES'] = ','.join(map(str, workerCores))
+
+        return environ
+
+    @staticmethod
+    def _splitInGroups(work, n):
+        """ Split (id, weight) pairs in at most n groups of similar total weight
+        (largest first, each one to the lightest group). Returns lists of ids. """
+        groups = [[] for _ in range(n)]
+        loads = [0] * n
+        for itemId, weight in sorted(work, key=lambda w: w[1], reverse=True):
+            i = loads.index(min(loads))
+            groups[i].append(itemId)
+            loads[i] += weight
+        return [g for g in groups if g]
+
+    @staticmethod
+    def _packVolumes(work, volumesPerJob):
+        """ Split work units in groups with the maps of volumesPerJob volumes. """
+        volIds = sorted({unit[0] for unit, _ in work})
+        groups = []
+        for i in range(0, len(volIds), volumesPerJob):
+            packed = set(volIds[i:i + volumesPerJob])
+            groups.append([unit for unit, _ in work if unit[0] in packed])
+        return groups
+
+    def _getInferenceSettings(self, vol, half=FULL_MAP):
+        """ Settings that change the enhanced map, part of the result cache key. """
+        settings = {'program': self._getBackend().program, 'version': V1}
+        if self.engine.get() != ENGINE_EAGER:
+            settings['engine'] = ENGINE_CHOICES[self.engine.get()]
+            if self.engine.get() != ENGINE_INT8:
+                settings['engineTolerance'] = self.engineTolerance.get()
+        if self.cropMap:
+            settings.update(cropThreshold=self.cropThreshold.get(),
+                            cropPadding=self.cropPadding.get())
+        if self.resampleMap:
+            settings['modelSampling'] = self.modelSampling.get()
+        if self._getVolumeTiles(vol, half):
+            settings.update(tileSize=self._getTileSize(), tileOverlap=self.tileOverlap.get())
+        # The result cache keeps the stored file
+        if self._compactsOutput():
+            settings.update(outputPrecision=OUTPUT_PRECISION_CHOICES[self.outputPrecision.get()],
+                            outputCompression=COMPRESSION_CHOICES[self.outputCompression.get()])
+        if self._cropsOutput():
+            settings['cropOutput'] = True
+        return settings
+
+    def _getBackend(self):
+        from cryoten import backends
+        return backends.getBackend(self.backend.get())
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
+        if (self.useHalfMaps and not self._isSetInput()
+                and not self.inputVolume.get().hasHalfMaps()):
+            errors.append("The input volume has no half maps associated.")
+        if self.engine.get() == ENGINE_FLOAT16 and not self.usesGpu():
+            errors.append("The float16 engine needs a GPU, use bfloat16 on CPU.")
+        if self.engine.get() == ENGINE_INT8 and self.usesGpu():
+            errors.append("The int8 engine only runs on CPU.")
+        suffix = COMPRESSION_SUFFIXES[self.outputCompression.get()]
+        if suffix and not mrcio.isCodecAvailable(suffix):
+            errors.append(f"The {COMPRESSION_CHOICES[self.outputCompression.get()]} compression "
+                          f"is not available, install the zstandard package in the "
+                          f"Scipion environment.")
+        if self.useTiles:
+            if 2 * self.tileOverlap.get() >= self.tileSize.get():
+                errors.append("The tile overlap must be smaller than half the tile size.")
+            # A tile, its weights and the weighted tile are in memory while blending
+            tileBytes = 3 * 4 * self.tileSize.get() ** 3
+            if tileBytes > self.maxMemory.get() * 1024 ** 3:
+                errors.append(f"Tiles of {self.tileSize.get()} voxels need "
+                              f"{tileBytes / 1024 ** 3:.1f} GB, more than the maximum memory.")
+        if not errors:
+            errors += self._validateInstallation()
+        if not errors:
+            errors += self._validateDiskSpace()
+        return errors
+
+    def _validateInstallation(self):
+        """ Backend installation (checkpoint and environment for cryoten, cached
+        by the plugin), engine and GPU ids. """
+        from cryoten import backends
+        if self.backend.get() not in backends.BACKENDS:
+            return [f"Unknown backend {self.backend.get()}, use one of: "
+                    f"{', '.join(backends.BACKENDS)}"]
+        backend = self._getBackend()
+        errors = backend.validate()
+        engine = ENGINE_CHOICES[self.engine.get()]
+        if backend.engines is not None and engine not in backend.engines:
+            errors.append(f"The {self.backend.get()} backend does not support the {engine} "
+                          f"engine, use one of: {', '.join(backend.engines)}")
+        devices = backend.getDevices() or {}
+        if engine == ENGINE_CHOICES[ENGINE_ONNX] and devices and not devices.get('onnxruntime'):
+            errors.append("The onnx engine needs onnxruntime in the cryoten environment, "
+                          "install it there or use the torchscript engine.")
+        # GPUs are checked on this machine, not on the nodes of a queue
+        gpus = devices.get('gpus')
+        if errors or gpus is None or not self.usesGpu() or self.useQueue():
+            return errors
+
+        wrongIds = [gpu for gpu in self.getGPUIds()
+                    if not gpu.isdigit() or int(gpu) >= len(gpus)]
+        if not gpus:
+            errors.append("The cryoten environment does not see any GPU, "
+                          "set 'Use GPU' to No to run on CPU.")
+        elif wrongIds:
+            errors.append(f"Wrong GPU ids {', '.join(wrongIds)}, the cryoten "
+                          f"environment sees {len(gpus)} GPUs (0 to {len(gpus) - 1}).")
         return errors
 
+    def _getInputHeaders(self):
+        """ Headers of the input maps to enhance. """
+        return [mrcio.readHeader(self._getInputFilePath(vol, half))
+                for vol in self._iterInputVolumes() for half in self._getMaps(vol)]
+
+    def _validateDiskSpace(self):
+        """ Room for the enhanced maps, and their tiles and grid copies. """
+        from cryoten import preflight
+        copies = 1 + bool(self.useTiles) + self._usesGrid()
+        neededBytes = copies * sum(4 * shape[0] * shape[1] * shape[2]
+                                   for shape, *_ in self._getInputHeaders())
+        return preflight.checkDiskSpace(self.getProject().getPath(), neededBytes)
+
+    def _warnings(self):
+        warnings = []
+        if self.useQueue():
+            return warnings  # Memory of the nodes is not known here
+        from cryoten import grid, preflight
+        hostMemory = preflight.getHostMemory()
+        if not hostMemory:
+            return warnings
+
+        # Largest box given to the network, scaled to the sampling of the model.
+        # The resampling of the whole map (the cropped region is not known yet)
+        # is done in memory by the protocol while the worker runs.
+        boxes = []
+        for header in self._getInputHeaders():
+            shape = header.shape
+            resampleBytes = 0
+            if self.resampleMap:
+                shape = [int(round(n * size / self.modelSampling.get()))
+                         for n, size in zip(shape, header.voxelSize[::-1])]
+                resampleBytes = grid.getResampleBytes(header.shape, shape)
+            if self.useTiles and max(shape) > self._getTileSize():
+                shape = [self._getTileSize()] * 3
+            boxes.append(preflight.estimateHostMemory(shape) + resampleBytes)
+        workers = self._getNumberOfSteps() if not self.useQueueForSteps() else 1
+        neededBytes = workers * max(boxes, default=0)
+        if neededBytes > hostMemory:
+            warnings.append(f"Enhancing the largest map with {workers} workers needs about "
+                            f"{neededBytes / 1024 ** 3:.1f} GB of memory, this machine has "
+                            f"{hostMemory / 1024 ** 3:.1f} GB. Consider using tiles"
+                            + (" or not resampling the maps." if self.resampleMap else "."))
+        return warnings
+
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
-        summary.append(f"Output file path set to: {self.outputFilePath}")
+        if self._isSetInput():
+            if self.hasAttribute('outputVolumes'):
+                summary.append(f"{self.outputVolumes.getSize()} volumes enhanced.")
+        else:
+            summary.append(f"Output file path set to: {self.outputFilePath}")
+
+        for fscObj in self._iterOutputFSCs():
+            summary.append(f"{fscObj.getObjLabel()}: resolution at FSC 0.143 "
+                           f"{fscObj.calculateResolution()} A")
+
+        if self.cacheHits.get() or self.cacheMisses.get():
+            summary.append(f"Result cache: {self.cacheHits.get()} hits, "
+                           f"{self.cacheMisses.get()} misses")
+
+        resumed = sum(stats.get('resumed', 0) for stats in self._loadWorkerStats())
+        if resumed:
+            summary.append(f"{resumed} maps or tiles kept from an interrupted run")
+
+        phases = self._loadMetrics().get('phases', {})
+        if phases:
+            summary.append("Time per phase:")
+            summary.extend("  " + metrics.formatPhase(phase, stats)
+                           for phase, stats in phases.items())
+
+        for stats in self._loadWorkerStats():
+            tiles = f" ({stats['tiles']} tiles)" if stats.get('tiles') else ''
+            startup = (f" (start-up {stats['startupSeconds']:.1f} s)"
+                       if stats.get('startupSeconds') is not None else '')
+            summary.append(f"{stats['worker']}: {stats['volumes']} volumes{tiles}, "
+                           f"{stats['bytes'] / 1024 ** 2:.0f} MB in {stats['seconds']:.0f} s"
+                           f"{startup}")
         return summary
 
     def _methods(self):
@@ -175,5 +1239,32 @@ class CryotenPrefixEnhace(EMProtocol):
         methods.append("This protocol enhances a map using the Cryoten software.")
         return methods
 
+    def _loadWorkerStats(self):
+        """ Work done by each worker, as written by the enhancement steps. """
+        stats = []
+        for statsFile in sorted(glob.glob(self._getExtraPath('worker_stats_*.json'))):
+            with open(statsFile) as f:
+                stats.extend(json.load(f))
+        return stats
+
+    def _iterOutputFSCs(self):
+        if self.hasAttribute('outputFSC'):
+            yield self.outputFSC
+        elif self.hasAttribute('outputFSCs'):
+            yield from self.outputFSCs.iterItems()
+
+    def _getMetricsFile(self):
+        return self._getExtraPath('metrics.json')
+
+    def _loadMetrics(self):
+        """ Phases timing written by createOutputStep, empty if not there yet. """
+        if not os.path.exists(self._getMetricsFile()):
+            return {}
+        with open(self._getMetricsFile()) as f:
+            return json.load(f)
+
     def getGPUIds(self):
-        return getattr(self, params.GPU_LIST).get().split(',')
\ No newline at end of file
+        """ GPU ids to use, empty when running on CPU. """
+        if not self.usesGpu():
+            return []
+        return [str(gpu) for gpu in self.getGpuList()]
\ No newline at end of file
@@ -0,0 +1,202 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import codecs
+import collections
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+PROGRESS_LOG_SECONDS = 30
+READ_CHUNK = 64 * 1024
+LINE_END = re.compile(r'(\r\n|\n|\r)')
+
+_running = set()
+_runningLock = threading.Lock()
+_handlersInstalled = False
+
+
+class ProcessRunner:
+    """ Run a child process in its own process group, forwarding its output
+    to the protocol log line by line while it runs.
+
+    Only the last lines are kept in memory (see tail), to report failures.
+    Progress updates (lines ended by a carriage return, as written by
+    progress bars) are kept in progress and only logged every
+    PROGRESS_LOG_SECONDS. With interactive=True the stdin and stdout of the
+    child are pipes left to the caller and only stderr is logged.
+
+        with ProcessRunner(command, prefix='[GPU 0] ') as runner:
+            returnCode = runner.wait()
+    """
+    def __init__(self, command, env=None, cwd=None, prefix='', interactive=False,
+                 log=None, tailLines=50):
+        self._command = command
+        self._env = env
+        self._cwd = cwd
+        self._prefix = prefix
+        self._interactive = interactive
+        self._log = log or (lambda line: print(line, flush=True))
+        self._process = None
+        self._forwarder = None
+        self.tail = collections.deque(maxlen=tailLines)
+        self.progress = None
+
+    @property
+    def stdin(self):
+        return self._process.stdin
+
+    @property
+    def stdout(self):
+        return self._process.stdout
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def start(self):
+        """ Launch the process, its output is forwarded by a background thread. """
+        pipe = subprocess.PIPE if self._interactive else None
+        self._process = subprocess.Popen(self._command, env=self._env, cwd=self._cwd,
+                                         stdin=pipe, stdout=pipe or subprocess.PIPE,
+                                         stderr=subprocess.PIPE if self._interactive
+                                         else subprocess.STDOUT,
+                                         universal_newlines=True, bufsize=1,
+                                         start_new_session=True)
+        with _runningLock:
+            _running.add(self)
+
+        logged = self._process.stderr if self._interactive else self._process.stdout
+        self._forwarder = threading.Thread(target=self._forward, args=(logged,), daemon=True)
+        self._forwarder.start()
+        return self
+
+    def _forward(self, stream):
+        lastProgress = 0
+        pending = ''
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # Raw chunks, without newline translation, to tell progress updates
+        # ('\r') apart and not to accumulate them while waiting for a '\n'
+        for chunk in iter(lambda: stream.buffer.read1(READ_CHUNK), b''):
+            *lines, pending = LINE_END.split(pending + decoder.decode(chunk))
+            for line, end in zip(lines[::2], lines[1::2]):
+                if not line.strip():
+                    continue
+                if end == '\r':
+                    self.progress = line
+                    if time.time() - lastProgress < PROGRESS_LOG_SECONDS:
+                        continue
+                    lastProgress = time.time()
+                self.tail.append(line)
+                self._log(self._prefix + line)
+        if pending.strip():
+            self.tail.append(pending)
+            self._log(self._prefix + pending)
+        stream.close()
+
+    def poll(self):
+        return self._process.poll()
+
+    def wait(self, timeout=None):
+        """ Wait for the process and for all its output to be logged. """
+        returnCode = self._process.wait(timeout)
+        self._forwarder.join()
+        with _runningLock:
+            _running.discard(self)
+        return returnCode
+
+    def run(self):
+        """ Run the process until it finishes, failing if it does not succeed. """
+        with self:
+            returnCode = self.wait()
+        if returnCode:
+            raise RuntimeError(f"{self._command[0]} failed with code {returnCode}:\n"
+                               + '\n'.join(self.tail))
+
+    def terminate(self, timeout=10):
+        """ Stop the whole process group: SIGTERM and, if it does not finish
+        in timeout seconds, SIGKILL. """
+        if self._process is None or self._process.poll() is not None:
+            return
+        _killGroup(self._process.pid, signal.SIGTERM)
+        try:
+            self._process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            _killGroup(self._process.pid, signal.SIGKILL)
+        self.wait()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, tb):
+        # A failure in the caller (or a cancellation) stops the process
+        if excType is not None:
+            self.terminate()
+
+
+def _killGroup(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def terminateAll(timeout=10):
+    """ Stop all the processes started by runners of this process. """
+    with _runningLock:
+        runners = list(_running)
+    for runner in runners:
+        _killGroup(runner.pid, signal.SIGTERM)
+    for runner in runners:
+        runner.terminate(timeout)
+
+
+def installSignalHandlers():
+    """ Stop the running children when the protocol is terminated (e.g. a queue
+    job cancelled). Children run in their own process group, so they do not
+    receive the signals sent to the protocol. Must be called from the main
+    thread. The previous handler is called afterwards. """
+    global _handlersInstalled
+    if _handlersInstalled:
+        return
+    _handlersInstalled = True
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            terminateAll()
+            if previous == signal.SIG_IGN:
+                return
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(sig, handler)
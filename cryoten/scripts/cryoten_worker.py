@@ -0,0 +1,505 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Persistent cryoten worker.
+
+This script runs inside the cryoten environment with the cryoten repository
+as working directory. It imports the heavy dependencies once and then keeps
+reading jobs from stdin, one JSON document per line:
+
+    {"id": 1, "input": "/path/in.mrc", "output": "/path/out.mrc"}
+
+For every job the cryoten evaluation script is executed in this same process,
+so the interpreter start-up, the torch/CUDA initialization and the checkpoint
+read are only paid once. One JSON reply per job is written to stdout:
+
+    {"id": 1, "ok": true, "seconds": 12.3, "cpu": 40.1, "peakRss": 1234567890,
+     "gpuPeakBytes": null, "phases": {"inference": {"wall": 11.0, "cpu": 38.2}}}
+
+where cpu is the CPU time of the job, peakRss the peak resident memory of the
+worker so far and gpuPeakBytes the peak memory allocated by torch on the GPU
+during the job. phases splits the job in modelLoad (torch.load and
+load_state_dict), inputRead and outputWrite (maps opened and written with
+mrcfile) and inference (the rest).
+
+After every job, and above all after a failed one, the objects it left
+behind are collected and the memory cached by torch on the GPU is released,
+so the next job of this long-lived process starts from the same memory.
+
+Anything printed by the evaluation script goes to stderr, so stdout is only
+used for the replies. An empty line or the end of stdin stops the worker.
+
+The following environment variables tune the execution:
+
+    CRYOTEN_CPU_CORES: comma separated cores the worker is pinned to.
+    CRYOTEN_INTRA_OP_THREADS, CRYOTEN_INTER_OP_THREADS: torch thread pools.
+    CRYOTEN_ENGINE: eager (default), float16 or bfloat16 (autocast of the
+        forward pass), int8 (dynamic quantization of the linear layers, CPU
+        only), torchscript or onnx (forward pass traced or exported to a
+        graph, run by TorchScript or ONNX Runtime).
+    CRYOTEN_CHECKPOINT: checkpoint of the model.
+    CRYOTEN_ENGINE_DIR: folder of the exported graphs and their checks,
+        next to the checkpoint if not given.
+    CRYOTEN_ENGINE_TOLERANCE: maximum difference with the eager forward pass,
+        relative to its largest value (default 0.01).
+
+Every engine but int8 is checked against the eager forward pass the first
+time an input shape is seen. The result is saved next to the exported
+graph, so the check is done once, and the eager forward pass is used if
+the difference is over the tolerance, or if the engine fails.
+"""
+
+import contextlib
+import gc
+import hashlib
+import json
+import os
+import runpy
+import sys
+import time
+import traceback
+
+# [wall, cpu] seconds of the phases of the current job
+_phases = {}
+# Graphs loaded by the engines and checks reported, by file
+_graphs = {}
+_reported = set()
+
+
+@contextlib.contextmanager
+def _timePhase(phase):
+    """ Add the time spent in the block to a phase of the current job. """
+    t0, c0 = time.time(), time.process_time()
+    try:
+        yield
+    finally:
+        times = _phases.setdefault(phase, [0.0, 0.0])
+        times[0] += time.time() - t0
+        times[1] += time.process_time() - c0
+
+
+def _cacheCheckpointLoads():
+    """ Make torch.load reuse checkpoints already read by this process. """
+    try:
+        import torch
+    except ImportError:
+        return
+
+    originalLoad = torch.load
+    cache = {}
+
+    def cachedLoad(f, *args, **kwargs):
+        # Lightning passes an open file object, plain torch code a path
+        path = getattr(f, 'name', None) or getattr(f, 'path', None) or f
+        if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+            return originalLoad(f, *args, **kwargs)
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime,
+               repr(kwargs.get('map_location')))
+        if key not in cache:
+            with _timePhase('modelLoad'):
+                cache[key] = originalLoad(f, *args, **kwargs)
+        return cache[key]
+
+    torch.load = cachedLoad
+
+
+def _configureThreads():
+    """ Pin the process to its cores and size the torch thread pools. """
+    cores = os.environ.get('CRYOTEN_CPU_CORES')
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [int(c) for c in cores.split(',')])
+
+    try:
+        import torch
+    except ImportError:
+        return
+
+    intraOp = os.environ.get('CRYOTEN_INTRA_OP_THREADS')
+    if intraOp:
+        torch.set_num_threads(int(intraOp))
+    interOp = os.environ.get('CRYOTEN_INTER_OP_THREADS')
+    if interOp:
+        torch.set_num_interop_threads(int(interOp))
+
+
+def _toFloat32(output):
+    """ Cast the floating point tensors of a model output back to float32. """
+    import torch
+    if isinstance(output, torch.Tensor):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, (list, tuple)):
+        return type(output)(_toFloat32(o) for o in output)
+    if isinstance(output, dict):
+        return {k: _toFloat32(v) for k, v in output.items()}
+    return output
+
+
+def _iterTensors(output):
+    import torch
+    if isinstance(output, torch.Tensor):
+        yield output
+    elif isinstance(output, (list, tuple)):
+        for o in output:
+            yield from _iterTensors(o)
+    elif isinstance(output, dict):
+        for o in output.values():
+            yield from _iterTensors(o)
+
+
+def _relativeError(expected, actual):
+    """ Largest difference between two outputs, relative to the largest value. """
+    error, scale = 0.0, 0.0
+    for e, a in zip(_iterTensors(expected), _iterTensors(actual)):
+        e, a = e.detach().float().cpu(), a.detach().float().cpu()
+        error = max(error, (e - a).abs().max().item())
+        scale = max(scale, e.abs().max().item())
+    return error / max(scale, 1e-12)
+
+
+class _EngineForward:
+    """ Forward pass of a module run by an engine other than eager, with one
+    graph (or autocast run) per input shape, checked against the eager
+    forward pass the first time. """
+    def __init__(self, module, engine):
+        self.module = module
+        self.engine = engine
+        self.tolerance = float(os.environ.get('CRYOTEN_ENGINE_TOLERANCE', 0.01))
+        self.eagerForward = module.forward
+        self.runners = {}
+        module.forward = self
+
+    def __call__(self, *args, **kwargs):
+        import torch
+        if kwargs or not args or not all(isinstance(a, torch.Tensor) for a in args):
+            return self.eagerForward(*args, **kwargs)
+        signature = tuple((tuple(a.shape), str(a.dtype), a.device.type) for a in args)
+        if signature not in self.runners:
+            self.runners[signature] = self._getRunner(signature, args)
+        return self.runners[signature](*args)
+
+    def _getPath(self, signature, extension):
+        """ File for the graph or check of an input signature, in CRYOTEN_ENGINE_DIR. """
+        import torch
+        checkpoint = os.environ.get('CRYOTEN_CHECKPOINT', 'cryoten.ckpt')
+        key = [self.engine, torch.__version__, repr(signature)]
+        if os.path.exists(checkpoint):
+            stat = os.stat(checkpoint)
+            key += [os.path.realpath(checkpoint), stat.st_size, stat.st_mtime]
+        folder = os.environ.get('CRYOTEN_ENGINE_DIR') or os.path.dirname(os.path.abspath(checkpoint))
+        name = f"{os.path.basename(checkpoint)}.{self.engine}-"
+        name += hashlib.md5(repr(key).encode()).hexdigest()[:12] + extension
+        return os.path.join(folder, name)
+
+    def _getRunner(self, signature, args):
+        """ Runner of the engine for the input signature, or the eager forward
+        pass if the engine differs from it or fails, e.g. when its graph can
+        not be exported or saved. """
+        try:
+            runner, check, checkPath = self._checkRunner(signature, args)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"WARNING: the {self.engine} engine failed for inputs {signature}, "
+                  f"using eager: {e}", file=sys.stderr)
+            return self.eagerForward
+
+        ok = check['relativeError'] <= self.tolerance
+        if checkPath not in _reported:
+            _reported.add(checkPath)
+            if ok:
+                print(f"Using the {self.engine} engine for inputs {signature}, relative "
+                      f"difference with eager {check['relativeError']:.2g}", file=sys.stderr)
+            else:
+                print(f"WARNING: the {self.engine} engine differs from eager by "
+                      f"{check['relativeError']:.2g} (tolerance {self.tolerance:.2g}) for "
+                      f"inputs {signature}, using eager", file=sys.stderr)
+        return runner if ok else self.eagerForward
+
+    def _checkRunner(self, signature, args):
+        """ Runner of the engine, its check against eager and the file of the check. """
+        import torch
+        if self.engine in ('float16', 'bfloat16'):
+            dtype = getattr(torch, self.engine)
+            deviceType = args[0].device.type
+
+            def runner(*inputs):
+                with torch.autocast(deviceType, dtype=dtype):
+                    return _toFloat32(self.eagerForward(*inputs))
+        elif self.engine in ('torchscript', 'onnx'):
+            runner = self._loadGraph(signature, args)
+        else:
+            raise ValueError(f"Unknown engine: {self.engine}")
+
+        # Check against eager once, the result is kept with the graph
+        checkPath = self._getPath(signature, '.json')
+        if os.path.exists(checkPath):
+            with open(checkPath) as f:
+                check = json.load(f)
+        else:
+            with torch.no_grad():
+                error = _relativeError(self.eagerForward(*args), runner(*args))
+            check = {'engine': self.engine, 'signature': repr(signature),
+                     'relativeError': error}
+            try:
+                _writeAtomic(checkPath, lambda path: _writeJson(path, check))
+            except OSError as e:
+                # Only the check is lost, it is done again by the next worker
+                print(f"WARNING: the check of the {self.engine} engine could not be "
+                      f"saved: {e}", file=sys.stderr)
+        return runner, check, checkPath
+
+    def _loadGraph(self, signature, args):
+        """ Runner of the graph exported for the input signature, exported
+        the first time and loaded once per worker. """
+        graphPath = self._getPath(signature, '.pt' if self.engine == 'torchscript' else '.onnx')
+        if graphPath not in _graphs:
+            with _timePhase('modelLoad'):
+                if not os.path.exists(graphPath):
+                    self._export(graphPath, args)
+                _graphs[graphPath] = self._newRunner(graphPath, args[0].device)
+        return _graphs[graphPath]
+
+    def _newRunner(self, graphPath, device):
+        import torch
+        if self.engine == 'torchscript':
+            graph = torch.jit.load(graphPath, map_location=device)
+            graph.eval()
+            return graph
+
+        import onnxruntime
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda':
+            providers.insert(0, ('CUDAExecutionProvider', {'device_id': device.index or 0}))
+        session = onnxruntime.InferenceSession(graphPath, providers=providers)
+        names = [i.name for i in session.get_inputs()]
+
+        def runner(*inputs):
+            outputs = session.run(None, {name: a.detach().cpu().numpy()
+                                         for name, a in zip(names, inputs)})
+            outputs = [torch.from_numpy(o).to(device) for o in outputs]
+            return outputs[0] if len(outputs) == 1 else tuple(outputs)
+        return runner
+
+    def _export(self, graphPath, args):
+        import torch
+        print(f"Exporting the model to {graphPath}", file=sys.stderr)
+        # The class forward pass is the one exported, not this wrapper
+        del self.module.forward
+        try:
+            # Tensors created in inference mode can not be traced
+            with torch.inference_mode(False), torch.no_grad():
+                args = tuple(a.clone() for a in args)
+                if self.engine == 'torchscript':
+                    graph = torch.jit.trace(self.module, args, check_trace=False)
+                    _writeAtomic(graphPath, lambda path: torch.jit.save(graph, path))
+                else:
+                    names = [f"input{i}" for i in range(len(args))]
+                    _writeAtomic(graphPath, lambda path: torch.onnx.export(
+                        self.module, args, path, input_names=names, dynamo=False))
+        finally:
+            self.module.forward = self
+
+
+def _writeJson(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def _writeAtomic(path, write):
+    """ Write a file with write(path) through a temporary file, so concurrent
+    workers never read it half written. """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmpPath)
+        os.replace(tmpPath, path)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+def _installModelHooks(engine):
+    """ Transform the model right after eval.py loads its weights.
+
+    The model is built inside eval.py, so the transformation is attached to
+    the first load_state_dict call made on each module.
+    """
+    if engine in (None, '', 'eager'):
+        return
+    import torch
+
+    def transform(module):
+        if engine == 'int8':
+            torch.quantization.quantize_dynamic(module, {torch.nn.Linear},
+                                                dtype=torch.qint8, inplace=True)
+        else:
+            _EngineForward(module, engine)
+
+    loadStateDict = torch.nn.Module.load_state_dict
+
+    def load_state_dict(self, *args, **kwargs):
+        result = loadStateDict(self, *args, **kwargs)
+        if not getattr(self, '_cryotenTransformed', False):
+            transform(self)
+            self._cryotenTransformed = True
+        return result
+
+    torch.nn.Module.load_state_dict = load_state_dict
+
+
+def _installPhaseHooks():
+    """ Time the model weights load and the maps read and written by eval.py.
+    Installed after the other hooks, so the model transformation is included. """
+    try:
+        import torch
+    except ImportError:
+        pass
+    else:
+        loadStateDict = torch.nn.Module.load_state_dict
+
+        def load_state_dict(self, *args, **kwargs):
+            with _timePhase('modelLoad'):
+                return loadStateDict(self, *args, **kwargs)
+
+        torch.nn.Module.load_state_dict = load_state_dict
+
+    try:
+        from mrcfile.mrcfile import MrcFile
+    except ImportError:
+        return
+
+    mrcInit, mrcClose = MrcFile.__init__, MrcFile.close
+
+    def __init__(self, name, mode='r', *args, **kwargs):
+        # Reading modes load the data when the file is opened
+        with _timePhase('outputWrite' if mode == 'w+' else 'inputRead'):
+            mrcInit(self, name, mode, *args, **kwargs)
+
+    def close(self):
+        if getattr(self, '_read_only', True):
+            return mrcClose(self)
+        with _timePhase('outputWrite'):
+            return mrcClose(self)
+
+    MrcFile.__init__, MrcFile.close = __init__, close
+
+
+def _gpuPeakBytes(reset=False):
+    """ Peak GPU memory allocated by torch, None if CUDA was not used. """
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_initialized():
+        return None
+    if reset:
+        torch.cuda.reset_peak_memory_stats()
+    return torch.cuda.max_memory_allocated()
+
+
+def _releaseMemory():
+    """ Collect the objects of the last job and return the GPU memory cached by torch. """
+    gc.collect()
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_initialized():
+        torch.cuda.empty_cache()
+
+
+def _peakRss():
+    """ Peak resident memory of this process in bytes, None if unknown. It is
+    read from /proc on Linux, where getrusage keeps the peak of the parent. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes in macOS, kilobytes elsewhere
+    return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+
+def _runEval(evalScript, inputPath, outputPath):
+    """ Run the evaluation script as if it was called from the command line. """
+    argv = sys.argv
+    sys.argv = [evalScript, inputPath, outputPath]
+    try:
+        runpy.run_path(evalScript, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError(f"{evalScript} exited with code {e.code}")
+    finally:
+        sys.argv = argv
+
+
+def main():
+    evalScript = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else 'eval.py')
+    # Same module search path as 'python eval.py'
+    sys.path.insert(0, os.path.dirname(evalScript))
+
+    # Keep the original stdout for the replies and send everything else to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def reply(**kwargs):
+        replies.write(json.dumps(kwargs) + '\n')
+        replies.flush()
+
+    t0 = time.time()
+    _configureThreads()
+    _cacheCheckpointLoads()
+    _installModelHooks(os.environ.get('CRYOTEN_ENGINE'))
+    _installPhaseHooks()
+    reply(event='ready', seconds=time.time() - t0, cpu=time.process_time())
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            break
+        job = json.loads(line)
+        _phases.clear()
+        _gpuPeakBytes(reset=True)
+        t0, c0 = time.time(), time.process_time()
+        try:
+            _runEval(evalScript, job['input'], job['output'])
+            seconds, cpu = time.time() - t0, time.process_time() - c0
+            phases = {phase: {'wall': wall, 'cpu': phaseCpu}
+                      for phase, (wall, phaseCpu) in _phases.items()}
+            phases['inference'] = {'wall': max(0.0, seconds - sum(p['wall'] for p in phases.values())),
+                                   'cpu': max(0.0, cpu - sum(p['cpu'] for p in phases.values()))}
+            reply(id=job.get('id'), ok=True, seconds=seconds, cpu=cpu,
+                  peakRss=_peakRss(), gpuPeakBytes=_gpuPeakBytes(), phases=phases)
+        except Exception as e:
+            traceback.print_exc()
+            reply(id=job.get('id'), ok=False, error=str(e),
+                  seconds=time.time() - t0)
+        finally:
+            # Tensors of a failed job are kept by its traceback until collected
+            _releaseMemory()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Stand-in of a queue system that runs the jobs on the local machine, to try
+the queue submission of the protocol without a cluster. Jobs run in the
+background and their id is their process id. To use it, add a host with
+this queue to the hosts.conf of Scipion:
+
+    [localhost]
+    PARALLEL_COMMAND = mpirun -np %_(JOB_NODES)d %_(COMMAND)s
+    NAME = SCIPION_DAEMON
+    ADDRESS = localhost
+    MANDATORY = False
+    QUEUE_SYSTEM = FakeQueue
+    SUBMIT_COMMAND = python /path/to/fake_queue.py submit %_(JOB_SCRIPT)s
+    CHECK_COMMAND = python /path/to/fake_queue.py check %_(JOB_ID)s
+    CANCEL_COMMAND = python /path/to/fake_queue.py cancel %_(JOB_ID)s
+    SUBMIT_TEMPLATE = #!/bin/bash
+        %_(JOB_COMMAND)s > %_(JOB_LOGS)s.out 2> %_(JOB_LOGS)s.err
+    QUEUES = {"local": []}
+    QUEUES_DEFAULT = {"JOB_GPUS": "0"}
+
+and run the protocol with the queue for its steps (QUEUE_FOR_JOBS=Y).
+"""
+
+import os
+import signal
+import subprocess
+import sys
+
+
+def submit(script):
+    with open(os.devnull, 'rb') as stdin:
+        process = subprocess.Popen(['bash', script], stdin=stdin,
+                                   start_new_session=True)
+    print(f"Submitted job {process.pid}")
+
+
+def isRunning(jobId):
+    try:
+        os.kill(jobId, 0)
+    except ProcessLookupError:
+        return False
+    # A finished job not waited for yet is a zombie
+    try:
+        with open(f'/proc/{jobId}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except OSError:
+        return True
+
+
+def check(jobId):
+    # No output means the job is done
+    if isRunning(jobId):
+        print(f"{jobId} running")
+
+
+def cancel(jobId):
+    try:
+        os.killpg(jobId, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+if __name__ == '__main__':
+    command, arg = sys.argv[1:3]
+    if command == 'submit':
+        submit(arg)
+    elif command == 'check':
+        check(int(arg))
+    elif command == 'cancel':
+        cancel(int(arg))
+    else:
+        sys.exit(f"Unknown command {command}, use submit, check or cancel")
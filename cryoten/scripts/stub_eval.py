@@ -0,0 +1,84 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Stand-in for the cryoten evaluation script, used by the benchmarks and by
+the fake backend of the protocol (see cryoten/backends.py).
+
+It takes the same command line (input and output maps) and applies a cheap
+deterministic smoothing filter instead of the network, so the whole
+enhancement path can be run and timed without GPU, checkpoint or network
+access. The following environment variables change its behaviour:
+
+    CRYOTEN_STUB_TIMING: if set, the seconds spent reading, computing and
+        writing are saved in <output>.timing.json.
+    CRYOTEN_STUB_FAIL: maps whose input path contains this text fail, to
+        test the handling of errors.
+    CRYOTEN_STUB_MAX_VOXELS: maps with more voxels run out of memory, to
+        test the back-off to smaller tiles.
+"""
+
+import json
+import os
+import sys
+import time
+
+import mrcfile
+import numpy as np
+
+
+def main():
+    inputPath, outputPath = sys.argv[1], sys.argv[2]
+    failOn = os.environ.get('CRYOTEN_STUB_FAIL')
+    if failOn and failOn in inputPath:
+        raise RuntimeError(f"Failing on purpose for {inputPath}")
+
+    t0 = time.time()
+    with mrcfile.open(inputPath, permissive=True) as mrc:
+        data = mrc.data.astype(np.float32)
+        voxelSize = mrc.voxel_size
+    t1 = time.time()
+
+    maxVoxels = os.environ.get('CRYOTEN_STUB_MAX_VOXELS')
+    if maxVoxels and data.size > int(maxVoxels):
+        raise RuntimeError(f"CUDA out of memory with {data.size} voxels")
+
+    result = data.copy()
+    for axis in range(3):
+        result += np.roll(data, 1, axis) + np.roll(data, -1, axis)
+    result /= 7
+    t2 = time.time()
+
+    with mrcfile.new(outputPath, overwrite=True) as mrc:
+        mrc.set_data(result)
+        mrc.voxel_size = voxelSize
+    t3 = time.time()
+
+    if os.environ.get('CRYOTEN_STUB_TIMING'):
+        with open(outputPath + '.timing.json', 'w') as f:
+            json.dump({'read': t1 - t0, 'compute': t2 - t1, 'write': t3 - t2}, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,11 +26,57 @@
 
 
 from os.path import exists
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
 import traceback
+from unittest import mock
 
-from pyworkflow.tests import BaseTest, setupTestProject
+import numpy as np
+import mrcfile
+
+from pyworkflow.constants import QUEUE_FOR_JOBS
+from pyworkflow.project import Manager
+from pyworkflow.tests import BaseTest, setupTestOutput, setupTestProject
+from pyworkflow.object import Set
+import pyworkflow.utils as pwutils
 import pwem.protocols as emprot
+from pwem.objects import SetOfVolumes
 from cryoten.protocols.protocol_cryoten import CryotenPrefixEnhace  # Adjusted import path
+from cryoten.cache import ResultCache
+from cryoten import mrcio, tiling
+from cryoten.runner import ProcessRunner
+from cryoten.worker import CryotenWorker
+from cryoten import batch, benchmark, fsc, grid, metrics, tuning, utils
+from cryoten.preflight import Preflight
+from cryoten.scripts import getScript
+
+
+def setEnviron(addCleanup, **variables):
+    """ Set environment variables until addCleanup calls back. """
+    patcher = mock.patch.dict(os.environ, variables)
+    patcher.start()
+    addCleanup(patcher.stop)
+
+
+class CryotenBaseTest(BaseTest):
+    """ Tests with their files in the test output folder, removed once they pass or fail. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.addClassCleanup(pwutils.cleanPath, cls.outputPath)
+
+    def getTmpDir(self, *names):
+        """ Empty folder for the running test. """
+        path = self.getOutputPath(self._testMethodName, *names)
+        pwutils.cleanPath(path)
+        pwutils.makePath(path)
+        self.addCleanup(pwutils.cleanPath, path)
+        return path
+
 
 class TestCryoten(BaseTest):
     @classmethod
@@ -76,6 +122,691 @@ class TestCryoten(BaseTest):
             traceback.print_exc()
             raise e
 
+class TestCryotenCache(CryotenBaseTest):
+    """ Result cache of enhanced maps, no cryoten installation needed. """
+    def _writeFile(self, name, content):
+        path = os.path.join(self.tmpDir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def setUp(self):
+        self.tmpDir = self.getTmpDir()
+        self.checkpoint = self._writeFile('cryoten.ckpt', 'weights')
+
+    def test_hitAndMiss(self):
+        cache = ResultCache(os.path.join(self.tmpDir, 'cache'), 1024)
+        inputPath = self._writeFile('input.mrc', 'map')
+        key = cache.makeKey(inputPath, self.checkpoint, {'version': '1'})
+        outputPath = self._writeFile('output.mrc', 'kept')
+
+        # A miss leaves the map of a previous run in place
+        self.assertFalse(cache.get(key, outputPath))
+        with open(outputPath) as f:
+            self.assertEqual(f.read(), 'kept')
+        cache.put(key, self._writeFile('result.mrc', 'enhanced'))
+        self.assertTrue(cache.get(key, outputPath))
+        with open(outputPath) as f:
+            self.assertEqual(f.read(), 'enhanced')
+
+        # Rewriting an output in place does not change the cached map
+        with open(outputPath, 'w') as f:
+            f.write('rewritten')
+        self.assertTrue(cache.get(key, os.path.join(self.tmpDir, 'other.mrc')))
+        with open(os.path.join(self.tmpDir, 'other.mrc')) as f:
+            self.assertEqual(f.read(), 'enhanced')
+
+        # Different settings must not reuse the result
+        otherKey = cache.makeKey(inputPath, self.checkpoint, {'version': '2'})
+        self.assertNotEqual(key, otherKey)
+
+    def test_lruEviction(self):
+        cache = ResultCache(os.path.join(self.tmpDir, 'cache'), 20)
+        keys = []
+        for i in range(3):
+            inputPath = self._writeFile(f'input{i}.mrc', f'map{i}')
+            keys.append(cache.makeKey(inputPath, self.checkpoint, {}))
+            cache.put(keys[-1], self._writeFile(f'result{i}.mrc', 'x' * 10))
+
+        outputPath = os.path.join(self.tmpDir, 'output.mrc')
+        self.assertFalse(cache.get(keys[0], outputPath))
+        self.assertTrue(cache.get(keys[2], outputPath))
+
+    def test_evictedByOtherProcess(self):
+        cache = ResultCache(os.path.join(self.tmpDir, 'cache'), 10)
+        key = cache.makeKey(self._writeFile('input.mrc', 'map'), self.checkpoint, {})
+        cache.put(key, self._writeFile('result.mrc', 'x' * 10))
+        entryPath = cache._getEntryPath(key)
+        outputPath = os.path.join(self.tmpDir, 'output.mrc')
+
+        # Evicted right after the copy: the map is still reused
+        with mock.patch('os.utime', side_effect=FileNotFoundError(entryPath)):
+            self.assertTrue(cache.get(key, outputPath))
+        # Evicted while the entries are listed
+        walk = list(os.walk(cache.path))
+        os.remove(entryPath)
+        with mock.patch('os.walk', return_value=walk):
+            cache.evict()
+        self.assertFalse(cache.get(key, outputPath))
+        with open(outputPath) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+
+
+class TestCryotenUtils(CryotenBaseTest):
+    """ Atomic writes of files. """
+    def test_atomicPath(self):
+        path = os.path.join(self.getTmpDir(), 'data.json')
+        utils.writeJson(path, {'a': 1})
+        # A failed write keeps the previous file and leaves nothing behind
+        with self.assertRaises(TypeError):
+            utils.writeJson(path, {'a': object()})
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'a': 1})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['data.json'])
+
+
+class TestCryotenTiling(CryotenBaseTest):
+    """ Tiled processing must give back the same map as processing it in one go. """
+    def test_blendTiles(self):
+        tmpDir = self.getTmpDir()
+        inputPath = os.path.join(tmpDir, 'input.mrc')
+        data = np.random.default_rng(0).random((70, 50, 61), dtype=np.float32)
+        with mrcfile.new(inputPath) as mrc:
+            mrc.set_data(data)
+            mrc.voxel_size = 1.5
+
+        tileSize, overlap = 32, 8
+        tiles = tiling.getTiles(mrcio.readHeader(inputPath).shape, tileSize, overlap)
+        tilePaths = []
+        for i, (corner, shape) in enumerate(tiles):
+            tilePath = os.path.join(tmpDir, f'tile_{i}.mrc')
+            tiling.extractTile(inputPath, corner, shape, tilePath)
+            # Stand-in for the network
+            with mrcfile.open(tilePath, mode='r+') as mrc:
+                mrc.data[:] = 2 * mrc.data + 1
+            tilePaths.append(tilePath)
+
+        outputPath = os.path.join(tmpDir, 'output.mrc')
+        # Small memory limit so the mappings are released several times
+        tiling.blendTiles(inputPath, outputPath, tiles, tilePaths, overlap,
+                          1024 ** 2, os.path.join(tmpDir, 'weights.dat'))
+
+        with mrcfile.open(outputPath) as mrc:
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 1.5, places=4)
+            np.testing.assert_allclose(mrc.data, 2 * data + 1, atol=1e-4)
+
+
+class TestCryotenMrcio(CryotenBaseTest):
+    """ Map checks, in place header updates and streamed writing. """
+    def test_checkMap(self):
+        path = os.path.join(self.getTmpDir(), 'map.mrc')
+        mrc = mrcio.createMap(path, (10, 12, 14), 2.0, (1.0, 2.0, 3.0))
+        mrc.data[:] = 1
+        mrc.close()
+
+        header = mrcio.checkMap(path, (10, 12, 14))
+        self.assertEqual(header.voxelSize, (2.0, 2.0, 2.0))
+        self.assertEqual(header.origin, (1.0, 2.0, 3.0))
+        with self.assertRaises(Exception):
+            mrcio.checkMap(path, (10, 12, 15))
+
+        mrcio.writeGeometry(path, (1.5, 1.5, 1.5), (0.0, 0.0, 0.0))
+        self.assertEqual(mrcio.readHeader(path).voxelSize, (1.5, 1.5, 1.5))
+        with mrcio.mapData(path) as mrc:
+            self.assertEqual(float(mrc.data.sum()), 10 * 12 * 14)
+
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 4)
+        with self.assertRaises(Exception):
+            mrcio.checkMap(path)
+
+    def test_writeMap(self):
+        tmpDir = self.getTmpDir()
+        path = os.path.join(tmpDir, 'map.mrc')
+        data = np.random.default_rng(0).normal(size=(9, 10, 11)).astype(np.float32)
+        mrc = mrcio.createMap(path, data.shape, 1.5, (1.0, 2.0, 3.0))
+        mrc.data[:] = data
+        mrc.close()
+
+        for suffix in ['.gz', '.bz2']:
+            outputPath = os.path.join(tmpDir, 'out.mrc' + suffix)
+            # Slabs of 2 sections
+            mrcio.writeMap(path, outputPath, np.float16, slabBytes=2 * 10 * 11 * 4)
+            header = mrcio.checkMap(outputPath, data.shape)
+            self.assertEqual((header.voxelSize, header.origin, header.dtype),
+                             ((1.5, 1.5, 1.5), (1.0, 2.0, 3.0), np.dtype(np.float16)))
+            with mrcio.openMap(outputPath) as mrc:
+                np.testing.assert_allclose(mrc.data, data, atol=0.01)
+                self.assertAlmostEqual(float(mrc.header.dmean), float(data.mean()), places=5)
+        self.assertEqual(sorted(os.listdir(tmpDir)), ['map.mrc', 'out.mrc.bz2', 'out.mrc.gz'])
+
+        # Scipion reads them once the reader is registered by the plugin
+        from pwem.emlib.image.image_readers import ImageReadersRegistry
+        from cryoten import Plugin
+        from cryoten.convert import CompressedMrcReader
+        Plugin.registerImageReaders()
+        reader = ImageReadersRegistry.getReader(outputPath)
+        self.assertIs(reader, CompressedMrcReader)
+        self.assertEqual(reader.getDimensions(outputPath), (11, 10, 9, 1))
+        np.testing.assert_allclose(reader.open(outputPath), data, atol=0.01)
+        # Other files with the same suffix keep their reader
+        self.assertIsNone(reader._getPreviousReader(outputPath))
+        self.assertIsNotNone(reader._getPreviousReader(os.path.join(tmpDir, 'images.tar.bz2')))
+
+
+class TestCryotenFSC(CryotenBaseTest):
+    """ FSC between enhanced half maps. """
+    def test_computeFSC(self):
+        tmpDir = self.getTmpDir()
+        path1, path2 = os.path.join(tmpDir, 'half1.mrc'), os.path.join(tmpDir, 'half2.mrc')
+        benchmark.writeSyntheticMap(path1, 32)
+        with mrcfile.open(path1) as mrc:
+            noise = np.random.default_rng(1).normal(0, 0.5, mrc.data.shape)
+            mrcfile.write(path2, (mrc.data + noise).astype(np.float32))
+
+        frequencies, values = fsc.computeFSC(path1, path1, 2.0)
+        np.testing.assert_allclose(values, 1, atol=1e-6)
+        self.assertAlmostEqual(frequencies[-1], 15 / 64)
+
+        _, values = fsc.computeFSC(path1, path2, 2.0)
+        self.assertGreater(values[1], 0.9)
+        self.assertLess(values[-1], 0.5)
+
+
+class TestCryotenGrid(CryotenBaseTest):
+    """ Crop and resampling to the working grid and back. """
+    def test_roundTrip(self):
+        tmpDir = self.getTmpDir()
+        inputPath = os.path.join(tmpDir, 'map.mrc')
+        z, y, x = np.indices((48, 40, 32))
+        data = np.exp(-((z - 20) ** 2 + (y - 15) ** 2 + (x - 12) ** 2) / 18).astype(np.float32)
+        mrcio.createMap(inputPath, data.shape, 0.5, (3, 4, 5)).close()
+        with mrcio.mapData(inputPath, writable=True) as mrc:
+            mrc.data[:] = data
+
+        transform = grid.getTransform(inputPath, 0.6, 0.01, 4)
+        self.assertEqual(transform['region'], [[7, 34], [2, 29], [0, 26]])
+        self.assertEqual(transform['workShape'], [22, 22, 22])
+
+        workPath, outputPath = os.path.join(tmpDir, 'work.mrc'), os.path.join(tmpDir, 'out.mrc')
+        grid.prepareMap(inputPath, workPath, transform)
+        header = mrcio.readHeader(workPath)
+        self.assertEqual(header.shape, (22, 22, 22))
+        np.testing.assert_allclose(header.origin, (3, 5, 8.5))
+
+        grid.restoreMap(workPath, outputPath, transform)
+        header = mrcio.readHeader(outputPath)
+        self.assertEqual((header.shape, header.voxelSize, header.origin),
+                         (data.shape, (0.5, 0.5, 0.5), (3, 4, 5)))
+        with mrcfile.open(outputPath) as mrc:
+            np.testing.assert_allclose(mrc.data, data, atol=0.05)
+
+    def test_fourierResample(self):
+        z, y, x = np.indices((31, 40, 33))
+        data = np.exp(-((z - 15) ** 2 + (y - 20) ** 2 + (x - 16) ** 2) / 30).astype(np.float32)
+        for shape in [(62, 80, 66), (47, 60, 50), (31, 40, 33)]:
+            resampled = grid.fourierResample(data, shape)
+            self.assertEqual((resampled.shape, resampled.dtype), (shape, np.float32))
+            # Going back to the original grid gives the same map
+            np.testing.assert_allclose(grid.fourierResample(resampled, data.shape), data,
+                                       atol=1e-4)
+        self.assertEqual(grid.getResampleBytes((10, 10, 10), (20, 20, 20)), 8 * 9000)
+
+
+class TestCryotenPreflight(CryotenBaseTest):
+    """ Cached checks of the installation. """
+    def test_checkInstallation(self):
+        home = self.getTmpDir()
+        cryotenPath = os.path.join(home, 'cryoten')
+        os.makedirs(cryotenPath)
+        checkpoint = os.path.join(cryotenPath, 'cryoten.ckpt')
+        with open(checkpoint, 'wb') as f:
+            f.write(b'weights')
+        envInfo = {'python': sys.executable, 'environ': {}}
+        preflight = Preflight(home, cryotenPath)
+
+        self.assertEqual(preflight.checkInstallation(lambda: envInfo, lambda: dict(os.environ)), [])
+        self.assertEqual(preflight.getDevices()['python'], sys.version.split()[0])
+        self.assertIn('onnxruntime', preflight.getDevices())
+
+        # Cached checks do not start the interpreter again
+        def getEnviron():
+            raise AssertionError("The environment was checked again")
+        self.assertEqual(preflight.checkInstallation(lambda: envInfo, getEnviron), [])
+
+        with open(checkpoint, 'wb') as f:
+            f.write(b'changed')
+        errors = preflight.checkInstallation(lambda: envInfo, getEnviron)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('corrupted', errors[0])
+
+
+class TestCryotenFake(CryotenBaseTest):
+    """ Whole protocol runs with the fake backend and synthetic volumes:
+    offline, on CPU and in seconds. """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        setupTestProject(cls)
+        cls.dataPath = cls.getOutputPath('data')
+        pwutils.makePath(cls.dataPath)
+        # Runs of the protocol inherit it, so the user cache is not touched
+        setEnviron(cls.addClassCleanup, CRYOTEN_CACHE_DIR=cls.getOutputPath('cache'))
+        for name, seed in [('map', 0), ('half1', 1), ('half2', 2), ('other', 3)]:
+            benchmark.writeSyntheticMap(os.path.join(cls.dataPath, f'{name}.mrc'), 40, seed)
+
+    def _importVolume(self):
+        prot = self.newProtocol(emprot.ProtImportVolumes,
+                                filesPath=os.path.join(self.dataPath, 'map.mrc'),
+                                samplingRate=1.0, setHalfMaps=True,
+                                half1map=os.path.join(self.dataPath, 'half1.mrc'),
+                                half2map=os.path.join(self.dataPath, 'half2.mrc'))
+        return self.launchProtocol(prot).outputVolume
+
+    def _newCryoten(self, inputVolume, **kwargs):
+        return self.newProtocol(CryotenPrefixEnhace, inputVolume=inputVolume, backend='fake',
+                                useGpu=False, **kwargs)
+
+    def test_tilesAndCache(self):
+        volume = self._importVolume()
+        runs = []
+        for _ in range(2):
+            prot = self._newCryoten(volume, useHalfMaps=True, useTiles=True,
+                                    tileSize=24, tileOverlap=4)
+            runs.append(self.launchProtocol(prot))
+
+        first, second = runs
+        self.assertEqual((first.cacheMisses.get(), first.cacheHits.get()), (3, 0))
+        self.assertEqual((second.cacheMisses.get(), second.cacheHits.get()), (0, 3))
+        self.assertEqual(first.outputVolume.getDim(), (40, 40, 40))
+        self.assertEqual(len(first.outputVolume.getHalfMaps(asList=True)), 2)
+        self.assertIsNotNone(first.outputFSC)
+        with mrcfile.open(first.outputVolume.getFileName()) as mrc1, \
+                mrcfile.open(second.outputVolume.getFileName()) as mrc2:
+            np.testing.assert_array_equal(mrc1.data, mrc2.data)
+
+    def test_batchWithError(self):
+        prot = self.newProtocol(emprot.ProtImportVolumes,
+                                filesPath=self.dataPath, filesPattern='[mo]*.mrc',
+                                samplingRate=1.0)
+        volumes = self.launchProtocol(prot).outputVolumes
+        self.assertEqual(volumes.getSize(), 2)
+
+        # With the cache, it is too small to keep the maps
+        setEnviron(self.addCleanup, CRYOTEN_CACHE_SIZE='0')
+        for useCache in [False, True]:
+            with self.subTest(useCache=useCache):
+                prot = self._newCryoten(volumes, useCache=useCache)
+                with mock.patch.dict(os.environ, CRYOTEN_STUB_FAIL='other'), \
+                        self.assertRaises(Exception):
+                    self.launchProtocol(prot)
+                self.assertIn('Failing on purpose', prot.getErrorMessage())
+
+                # Once fixed, resuming the run keeps the volume enhanced before the error
+                prot = self.launchProtocol(prot)
+                self.assertEqual(prot.outputVolumes.getSize(), 2)
+                self.assertIn("1 maps or tiles kept from an interrupted run",
+                              prot.summary())
+
+    def test_failedWorker(self):
+        prot = self.newProtocol(CryotenPrefixEnhace, backend='fake', useGpu=True)
+        units = [(1, 0, None), (2, 0, None)]
+
+        def runWorker(workerId, cryotenPath, device, units, workers, cancelled):
+            if device == '0':
+                # Killed by the step once the other one fails
+                cancelled.wait(60)
+                raise RuntimeError("Cryoten worker exited unexpectedly with code -15")
+            raise ValueError("Failing on purpose")
+
+        executor = mock.Mock(**{'getGpuList.return_value': [0, 1]})
+        with mock.patch.object(prot, '_stepsExecutor', executor, create=True), \
+                mock.patch.object(prot, '_getInputWork', return_value=[(u, 1) for u in units]), \
+                mock.patch.object(prot, '_runWorker', side_effect=runWorker):
+            # The failure of the second worker is raised, not the first one stopped by it
+            with self.assertRaisesRegex(ValueError, 'Failing on purpose'):
+                prot._runWorkers(1, self.dataPath, units)
+
+    def _waitProtocol(self, prot, condition, timeOut=300):
+        """ Update prot until condition(prot) holds or it is no longer running. """
+        t0 = time.time()
+        while not condition(prot) and prot.isActive() and time.time() - t0 < timeOut:
+            time.sleep(1)
+            self.proj._updateProtocol(prot)
+        return prot
+
+    def test_streaming(self):
+        prot = self.newProtocol(emprot.ProtImportVolumes,
+                                filesPath=self.dataPath, filesPattern='[mo]*.mrc',
+                                samplingRate=1.0)
+        volumes = self.launchProtocol(prot).outputVolumes
+        items = [vol.clone() for vol in volumes]
+        setPath = volumes.getFileName()
+        volumes.close()
+
+        # The input set is written again open with its first volume only
+        os.remove(setPath)
+        streamSet = SetOfVolumes(filename=setPath)
+        streamSet.setSamplingRate(1.0)
+        streamSet.setStreamState(Set.STREAM_OPEN)
+        streamSet.append(items[0])
+        streamSet.write()
+        streamSet.close()
+
+        prot = self._newCryoten(volumes, useCache=False)
+        self.proj.launchProtocol(prot, wait=False)
+        prot = self._waitProtocol(prot, lambda p: p.hasAttribute('outputVolumes'))
+        self.assertEqual(prot.outputVolumes.getSize(), 1)
+        self.assertFalse(prot.outputVolumes.isStreamClosed())
+
+        # The second volume arrives and the input is closed
+        streamSet = SetOfVolumes(filename=setPath)
+        streamSet.loadAllProperties()
+        streamSet.enableAppend()
+        streamSet.append(items[1])
+        streamSet.setStreamState(Set.STREAM_CLOSED)
+        streamSet.write()
+        streamSet.close()
+
+        prot = self._waitProtocol(prot, lambda p: not p.isActive())
+        self.assertTrue(prot.isFinished(), prot.getErrorMessage())
+        self.assertEqual(prot.outputVolumes.getSize(), 2)
+        self.assertTrue(prot.outputVolumes.isStreamClosed())
+
+
+class TestCryotenRunner(BaseTest):
+    """ Child processes with live logging and cancellation. """
+    def test_streamOutput(self):
+        lines = []
+        script = ("import sys\n"
+                  "print('start', flush=True)\n"
+                  "sys.stderr.write('\\r10%\\r100%')\n"
+                  "print('\\nend')")
+        ProcessRunner([sys.executable, '-c', script], prefix='> ', log=lines.append).run()
+        self.assertEqual(lines[0], '> start')
+        self.assertEqual(lines[-1], '> end')
+
+        with self.assertRaises(RuntimeError):
+            ProcessRunner([sys.executable, '-c', 'exit(3)'], log=lines.append).run()
+
+    def test_workerGone(self):
+        # Ready, then gone before the job is sent
+        script = ("import sys\n"
+                  "print('{\"event\": \"ready\"}', flush=True)\n"
+                  "sys.stderr.write('CUDA error: device lost\\n')")
+        worker = CryotenWorker([sys.executable, '-c', script], name='Worker 1').start()
+        worker._process.wait()
+        with self.assertRaisesRegex(RuntimeError, '(?s)exited unexpectedly with code 0:.*device lost'):
+            worker.enhance('input.mrc', 'output.mrc')
+
+    def test_terminateGroup(self):
+        # The shell and its background child are stopped together
+        runner = ProcessRunner(['bash', '-c', 'sleep 60 & sleep 60'], log=print).start()
+        t0 = time.time()
+        runner.terminate()
+        self.assertIsNotNone(runner.poll())
+        self.assertLess(time.time() - t0, 10)
+
+
+class TestCryotenBatch(CryotenBaseTest):
+    """ Jobs of a worker, with the stub model. """
+    def test_failedTile(self):
+        tmpDir = self.getTmpDir()
+        mapPath = os.path.join(tmpDir, 'map.mrc')
+        benchmark.writeSyntheticMap(mapPath, 32)
+        tileInputPath = os.path.join(tmpDir, 'tile_00000_in.mrc')
+        sharedPath = mrcio.getSharedPath(tileInputPath, 4 * 16 ** 3)
+        job = {'input': sharedPath, 'output': os.path.join(tmpDir, 'tile_00000.mrc'),
+               'tile': [mapPath, [0, 0, 0], [16, 16, 16]]}
+        command = [sys.executable, getScript('cryoten_worker.py'), getScript('stub_eval.py')]
+        env = dict(os.environ, CRYOTEN_STUB_FAIL='tile_00000_in')
+        worker = CryotenWorker(command, env=env, cwd=tmpDir, name='Worker 1')
+        with self.assertRaises(RuntimeError):
+            batch.runJobs(worker, [job], metrics.PhaseTimer())
+
+        # The input tile is removed even if the job fails, and then its shared folder
+        self.assertFalse(exists(sharedPath))
+        mrcio.removeSharedFiles([tileInputPath])
+        if sharedPath != tileInputPath:
+            self.assertFalse(exists(os.path.dirname(sharedPath)))
+
+
+class TestCryotenTuning(CryotenBaseTest):
+    """ Back-off to smaller tiles on out of memory errors, with the stub model. """
+    def test_backoff(self):
+        tmpDir = self.getTmpDir()
+        inputPath = os.path.join(tmpDir, 'input.mrc')
+        outputPath = os.path.join(tmpDir, 'output.mrc')
+        benchmark.writeSyntheticMap(inputPath, 64)
+        command = [sys.executable, getScript('cryoten_worker.py'), getScript('stub_eval.py')]
+        env = dict(os.environ, CRYOTEN_STUB_MAX_VOXELS=str(50 ** 3))
+        worker = CryotenWorker(command, env=env, cwd=tmpDir, name='Worker 1')
+        tuningFile = os.path.join(tmpDir, 'tuning.json')
+        tuningSettings = {'file': tuningFile, 'key': 'host/GPU', 'overlap': 4,
+                          'maxMemory': 1024 ** 3}
+        smallPath = os.path.join(tmpDir, 'small.mrc')
+        benchmark.writeSyntheticMap(smallPath, 32)
+        jobs = [{'input': inputPath, 'output': outputPath},
+                {'input': smallPath, 'output': os.path.join(tmpDir, 'small_out.mrc')}]
+        batch.runJobs(worker, jobs, metrics.PhaseTimer(), tuningSettings=tuningSettings)
+
+        self.assertEqual(mrcio.checkMap(outputPath).shape, (64, 64, 64))
+        self.assertEqual(sorted(os.listdir(tmpDir)),
+                         ['input.mrc', 'output.mrc', 'small.mrc', 'small_out.mrc', 'tuning.json'])
+        # Only the map enhanced in tiles is marked, it must not be cached as a whole map
+        self.assertEqual([job.get('backoff') for job in jobs], [True, None])
+        tuner = tuning.Tuner(tuningFile)
+        self.assertEqual(tuner.getRecord('host/GPU'),
+                         {'okVoxels': 48 ** 3, 'oomVoxels': 64 ** 3})
+        # Later runs start below the size that failed, whatever the free memory
+        self.assertEqual(tuner.getTileSize('host/GPU', 1024 ** 4, 1, 32, 256), 48)
+        self.assertEqual(tuner.getTileSize('other/GPU', 1024 ** 4, 1, 32, 256), 256)
+        self.assertEqual(tuner.getTileSize('other/GPU', None, 1, 32, 256), 256)
+
+
+class TestCryotenBenchmark(CryotenBaseTest):
+    """ Enhancement paths with the stub model, no cryoten installation needed. """
+    def test_runCase(self):
+        for path in benchmark.PATHS:
+            workDir = self.getTmpDir(path)
+            benchmark.writeInputs(path, 24, 2, workDir)
+            metrics = benchmark.runCase(path, 24, workDir, batch=2)
+            self.assertEqual(metrics['voxels'], (2 if path == 'batch' else 1) * 24 ** 3)
+            self.assertGreater(metrics['voxelsPerSecond'], 0)
+            self.assertGreater(metrics['workerPeakRssBytes'], 0)
+            self.assertLessEqual(metrics['startupSeconds'], metrics['wallSeconds'])
+
+
+class TestCryotenQueue(CryotenBaseTest):
+    """ Batch of maps run as a job of the local fake queue, with the stub model. """
+    def test_submitBatch(self):
+        tmpDir = self.getTmpDir()
+        jobs = []
+        for i in range(2):
+            inputPath = os.path.join(tmpDir, f'input_{i}.mrc')
+            benchmark.writeSyntheticMap(inputPath, 16, seed=i)
+            jobs.append({'input': inputPath, 'output': os.path.join(tmpDir, f'output_{i}.mrc')})
+        command = [sys.executable, getScript('cryoten_worker.py'), getScript('stub_eval.py')]
+        batchPath = os.path.join(tmpDir, 'batch.json')
+        result = batch.writeBatch(batchPath, 'Queue job 1', command, tmpDir, {}, jobs)['result']
+
+        # Same job script as the SUBMIT_TEMPLATE of the fake queue
+        packagePath = os.path.dirname(os.path.dirname(os.path.dirname(batch.__file__)))
+        script = os.path.join(tmpDir, 'job.sh')
+        with open(script, 'w') as f:
+            f.write(f'cd {packagePath} && {sys.executable} -m cryoten.batch {batchPath} '
+                    f'> {tmpDir}/job.out 2>&1\n')
+
+        def queue(*args):
+            return subprocess.check_output([sys.executable, getScript('fake_queue.py')]
+                                           + list(args), universal_newlines=True)
+
+        jobId = queue('submit', script).split()[-1]
+        t0 = time.time()
+        while queue('check', jobId) and time.time() - t0 < 60:
+            time.sleep(0.5)
+        self.assertEqual(queue('check', jobId), '')
+
+        self.assertTrue(exists(result), open(os.path.join(tmpDir, 'job.out')).read())
+        for job in jobs:
+            self.assertEqual(mrcio.checkMap(job['output']).shape, (16, 16, 16))
+
+
+class TestCryotenQueueProtocol(CryotenBaseTest):
+    """ Protocol steps sent to the local fake queue, with the fake backend. """
+    HOSTS = """[localhost]
+PARALLEL_COMMAND = mpirun -np %_(JOB_NODES)d %_(COMMAND)s
+NAME = SCIPION_DAEMON
+MANDATORY = False
+SUBMIT_COMMAND = {queue} submit %_(JOB_SCRIPT)s
+CHECK_COMMAND = {queue} check %_(JOB_ID)s
+CANCEL_COMMAND = {queue} cancel %_(JOB_ID)s
+SUBMIT_TEMPLATE = #!/bin/bash
+    %_(JOB_COMMAND)s > %_(JOB_LOGS)s.out 2> %_(JOB_LOGS)s.err
+QUEUES = {{"local": []}}
+QUEUES_DEFAULT = {{"JOB_GPUS": "0"}}
+"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        hostsConf = cls.getOutputPath('hosts.conf')
+        with open(hostsConf, 'w') as f:
+            f.write(cls.HOSTS.format(queue=f"{sys.executable} {getScript('fake_queue.py')}"))
+        cls.dataPath = cls.getOutputPath('data')
+        pwutils.makePath(cls.dataPath)
+        for name, seed in [('map', 0), ('other', 3)]:
+            benchmark.writeSyntheticMap(os.path.join(cls.dataPath, f'{name}.mrc'), 24, seed)
+        # As setupTestProject, with the queue in the hosts of the project
+        cls.proj = Manager().createProject(cls.__name__, hostsConf=hostsConf)
+        cls.addClassCleanup(os.chdir, os.getcwd())
+        os.chdir(cls.proj.path)
+        setEnviron(cls.addClassCleanup, CRYOTEN_CACHE_DIR=cls.getOutputPath('cache'))
+
+    def test_failedJob(self):
+        prot = self.newProtocol(emprot.ProtImportVolumes,
+                                filesPath=self.dataPath, filesPattern='*.mrc',
+                                samplingRate=1.0)
+        volumes = self.launchProtocol(prot).outputVolumes
+
+        prot = self.newProtocol(CryotenPrefixEnhace, inputVolume=volumes, backend='fake',
+                                useGpu=False, useCache=False)
+        prot._useQueue.set(True)
+        prot.setQueueParams(['local', {QUEUE_FOR_JOBS: 'Y'}])
+        with mock.patch.dict(os.environ, CRYOTEN_STUB_FAIL='other'), \
+                self.assertRaises(Exception):
+            self.launchProtocol(prot)
+        self.assertIn('did not finish, 1 of 2 maps or tiles missing', prot.getErrorMessage())
+        self.assertTrue(glob.glob(prot._getLogsPath('*.job')))
+
+        # Resumed, the map enhanced by the failed job is kept
+        prot = self.launchProtocol(prot)
+        self.assertEqual(prot.outputVolumes.getSize(), 2)
+        self.assertIn("1 maps or tiles kept from an interrupted run", prot.summary())
+        for volume in prot.outputVolumes:
+            self.assertEqual(mrcio.checkMap(volume.getFileName()).shape, (24, 24, 24))
+
+
+class TestCryotenEngine(CryotenBaseTest):
+    """ Inference engines of the worker on a small torch model. """
+    EVAL = """
+import sys, mrcfile, torch
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 1, 3, padding=1)
+    def forward(self, x):
+        return torch.relu(self.conv(x))
+net = Net()
+net.load_state_dict(torch.load('cryoten.ckpt'))
+with torch.inference_mode():
+    output = net(torch.from_numpy(mrcfile.read(sys.argv[1]))[None, None])
+mrcfile.write(sys.argv[2], output[0, 0].numpy(), overwrite=True)
+"""
+
+    def test_torchscript(self):
+        try:
+            import torch
+        except ImportError:
+            self.skipTest("torch is not installed")
+        tmpDir = self.getTmpDir()
+        with open(os.path.join(tmpDir, 'eval.py'), 'w') as f:
+            f.write(self.EVAL)
+        torch.save({'conv.weight': torch.rand(1, 1, 3, 3, 3), 'conv.bias': torch.zeros(1)},
+                   os.path.join(tmpDir, 'cryoten.ckpt'))
+        inputPath = os.path.join(tmpDir, 'input.mrc')
+        benchmark.writeSyntheticMap(inputPath, 16)
+
+        engineDir = os.path.join(tmpDir, 'engines')
+        # A folder that can not be created: the graph is not saved and eager is used
+        readOnlyDir = os.path.join(inputPath, 'engines')
+        outputs = {}
+        for name, engine, folder in [('eager', 'eager', engineDir),
+                                     ('torchscript', 'torchscript', engineDir),
+                                     ('readOnly', 'torchscript', readOnlyDir)]:
+            env = dict(os.environ, CRYOTEN_ENGINE=engine, CRYOTEN_ENGINE_DIR=folder,
+                       CRYOTEN_CHECKPOINT=os.path.join(tmpDir, 'cryoten.ckpt'))
+            outputs[name] = os.path.join(tmpDir, f'output_{name}.mrc')
+            command = [sys.executable, getScript('cryoten_worker.py'), 'eval.py']
+            with CryotenWorker(command, env=env, cwd=tmpDir) as worker:
+                for _ in range(2):  # Exported, then loaded from the cache
+                    worker.enhance(inputPath, outputs[name])
+
+        self.assertEqual(len([f for f in os.listdir(engineDir) if f.endswith('.pt')]), 1)
+        for name in ['torchscript', 'readOnly']:
+            np.testing.assert_allclose(mrcfile.read(outputs[name]),
+                                       mrcfile.read(outputs['eager']), atol=1e-5)
+
+
+class TestCryotenImport(BaseTest):
+    """ Cost of the plugin for the start-up of Scipion. """
+    BUDGET = 0.5  # seconds, for the plugin and for its protocols
+
+    def test_importBudget(self):
+        # In a new process, with what Scipion loads before the plugins
+        script = ("import json, sys, time\n"
+                  "import pwem, pwem.protocols, pwem.objects\n"
+                  "t0 = time.perf_counter()\n"
+                  "from cryoten import Plugin\n"
+                  "t1 = time.perf_counter()\n"
+                  "import cryoten.protocols, cryoten.wizards, cryoten.viewers\n"
+                  "t2 = time.perf_counter()\n"
+                  "print(json.dumps({'plugin': t1 - t0, 'protocols': t2 - t1,\n"
+                  "                  'modules': [m for m in sys.modules if m.startswith('cryoten')]}))")
+        packagePath = os.path.dirname(os.path.dirname(os.path.dirname(batch.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=packagePath,
+                                         universal_newlines=True)
+        result = json.loads(output.splitlines()[-1])
+
+        self.assertLess(result['plugin'], self.BUDGET)
+        self.assertLess(result['protocols'], self.BUDGET)
+        # Only needed to run the protocol
+        for module in ['cryoten.batch', 'cryoten.cache', 'cryoten.convert', 'cryoten.fsc',
+                       'cryoten.grid', 'cryoten.tiling', 'cryoten.worker']:
+            self.assertNotIn(module, result['modules'])
+
+
+class TestCryotenMetrics(BaseTest):
+    """ Per phase instrumentation of the workers. """
+    def test_mergePhases(self):
+        gpu0, gpu1 = metrics.PhaseTimer(gpu='0'), metrics.PhaseTimer(gpu='1')
+        reply = {'peakRss': 100, 'gpuPeakBytes': 50,
+                 'phases': {'inference': {'wall': 2.0, 'cpu': 3.0},
+                            'inputRead': {'wall': 1.0, 'cpu': 0.5}}}
+        gpu0.addReply(reply)
+        gpu1.addReply(dict(reply, peakRss=200))
+        with gpu1.measure('environment'):
+            pass
+
+        phases = metrics.mergePhases([gpu0.phases, gpu1.phases])
+        self.assertEqual(list(phases), ['environment', 'inputRead', 'inference'])
+        self.assertAlmostEqual(phases['inference']['wall'], 4.0)
+        self.assertEqual(phases['inference']['peakRss'], 200)
+        self.assertEqual(phases['inference']['gpuPeakBytes'], 50)
+        self.assertIsNone(phases['inputRead']['gpuPeakBytes'])
+        self.assertEqual(phases['inference']['gpus'], ['0', '1'])
+
+
 # Example of running the test
 if __name__ == '__main__':
     import unittest
@@ -0,0 +1,176 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Tiled processing of large maps with bounded memory.
+
+The input map is memory mapped and cut in overlapping cubic tiles that are
+enhanced one by one. The enhanced tiles are blended back into a memory mapped
+output using a cosine taper over the overlap, so the peak memory depends on
+the tile size and not on the size of the box.
+"""
+
+import os
+
+import numpy as np
+
+from . import mrcio
+
+
+def getTileStarts(size, tileSize, overlap):
+    """ Start of the tiles along one axis, the last one is flush with the end. """
+    if size <= tileSize:
+        return [0]
+    step = tileSize - overlap
+    return list(range(0, size - tileSize, step)) + [size - tileSize]
+
+
+def getTiles(shape, tileSize, overlap):
+    """ (z, y, x) corner and shape of the tiles covering a map of the given shape. """
+    tileShape = tuple(min(tileSize, n) for n in shape)
+    return [((z, y, x), tileShape)
+            for z in getTileStarts(shape[0], tileSize, overlap)
+            for y in getTileStarts(shape[1], tileSize, overlap)
+            for x in getTileStarts(shape[2], tileSize, overlap)]
+
+
+def getBlendWeights(tileShape, overlap):
+    """ Separable cosine taper over the overlap. Weights never reach 0, so the
+    borders of the map (only covered by one tile) keep their values. """
+    weights = np.ones(tileShape, dtype=np.float32)
+    for axis, n in enumerate(tileShape):
+        m = min(overlap, n // 2)
+        if m == 0:
+            continue
+        ramp = np.ones(n, dtype=np.float32)
+        taper = 0.5 - 0.5 * np.cos(np.pi * (np.arange(m) + 0.5) / m)
+        ramp[:m] = taper
+        ramp[n - m:] = taper[::-1]
+        shape = [1, 1, 1]
+        shape[axis] = n
+        weights *= ramp.reshape(shape)
+    return weights
+
+
+def getTileSlices(corner, tileShape):
+    return tuple(slice(c, c + n) for c, n in zip(corner, tileShape))
+
+
+def extractTile(inputPath, corner, tileShape, tilePath):
+    """ Write one tile of the map in inputPath as a small mrc file. The tile
+    is copied from the mapped input straight into the mapped tile file. """
+    voxelSize = mrcio.readHeader(inputPath).voxelSize
+    with mrcio.mapData(inputPath) as mrc:
+        tile = mrcio.createMap(tilePath, tileShape, voxelSize)
+        try:
+            tile.data[:] = mrc.data[getTileSlices(corner, tileShape)]
+        finally:
+            tile.close()
+
+
+def blendTiles(inputPath, outputPath, tiles, tilePaths, overlap, maxMemory, weightsPath):
+    """ Blend the enhanced tiles into a new map at outputPath.
+
+    Params:
+        tiles: list of (corner, shape) as returned by getTiles.
+        tilePaths: enhanced tile for each item of tiles.
+        maxMemory: bytes of the memory mapped output that can be touched
+            before the mappings are flushed and released.
+        weightsPath: scratch file for the accumulated weights.
+    """
+    header = mrcio.readHeader(inputPath)
+    shape = header.shape
+    mrcio.createMap(outputPath, shape, header.voxelSize, header.origin).close()
+
+    weightsCache = {}
+    accumulators = _BlendAccumulators(outputPath, weightsPath, shape, maxMemory)
+    try:
+        for (corner, tileShape), tilePath in zip(tiles, tilePaths):
+            enhancedShape = mrcio.readHeader(tilePath).shape
+            if enhancedShape != tuple(tileShape):
+                raise Exception(f"Enhanced tile {tilePath} has shape {enhancedShape} instead "
+                                f"of {tuple(tileShape)}. This map can not be processed in tiles.")
+            if tileShape not in weightsCache:
+                weightsCache[tileShape] = getBlendWeights(tileShape, overlap)
+            weights = weightsCache[tileShape]
+            with mrcio.mapData(tilePath) as tileMrc:
+                weighted = tileMrc.data * weights
+            accumulators.add(getTileSlices(corner, tileShape), weighted, weights)
+
+        accumulators.normalize()
+    finally:
+        accumulators.close()
+        if os.path.exists(weightsPath):
+            os.remove(weightsPath)
+
+
+class _BlendAccumulators:
+    """ Memory mapped weighted sum and weights of the blended map. The mappings
+    are dropped every maxMemory touched bytes to keep the resident size bounded. """
+    def __init__(self, outputPath, weightsPath, shape, maxMemory):
+        self._outputPath = outputPath
+        self._shape = shape
+        self._maxMemory = maxMemory
+        self._touched = 0
+        self._output = None
+        self._weights = np.memmap(weightsPath, dtype=np.float32, mode='w+', shape=shape)
+        self._weightsPath = weightsPath
+        self._open()
+
+    def _open(self):
+        self._output = mrcio.mapData(self._outputPath, writable=True)
+        if self._weights is None:
+            self._weights = np.memmap(self._weightsPath, dtype=np.float32, mode='r+',
+                                      shape=self._shape)
+
+    def _release(self):
+        self._output.close()
+        self._weights.flush()
+        self._weights = None
+
+    def _touch(self, nbytes):
+        self._touched += nbytes
+        if self._touched > self._maxMemory:
+            self._release()
+            self._open()
+            self._touched = 0
+
+    def add(self, slices, values, weights):
+        self._output.data[slices] += values
+        self._weights[slices] += weights
+        self._touch(values.nbytes + weights.nbytes)
+
+    def normalize(self):
+        """ Divide the weighted sum by the weights in slabs of z sections. """
+        sectionBytes = 2 * 4 * self._shape[1] * self._shape[2]
+        slab = max(1, int(self._maxMemory // (2 * sectionBytes)))
+        for z in range(0, self._shape[0], slab):
+            section = slice(z, z + slab)
+            self._output.data[section] /= np.maximum(self._weights[section], np.finfo(np.float32).tiny)
+            self._touch(sectionBytes * min(slab, self._shape[0] - z))
+
+    def close(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+        self._weights = None
@@ -0,0 +1,167 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Tile size tuned to the memory of each machine.
+
+The box given to the network is chosen at the start of a run from the free
+memory of the GPU (or of the host for CPU workers). What was learnt by
+previous runs on the same host and GPU model takes precedence over that
+estimate: the largest box enhanced without problems and the smallest one
+that ran out of memory. They are kept in a JSON file shared by all the
+projects of the user, see Tuner.
+
+A map (or tile) that runs out of memory anyway is enhanced again in
+smaller tiles (see cryoten.batch), and the failure is recorded, so later
+runs start below it.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import threading
+
+from .utils import writeJson
+
+MIN_TILE_SIZE = 32
+BACKOFF = 0.75  # size of the tiles of a map that ran out of memory, relative to it
+SAFETY = 0.8  # fraction of the free memory that is used
+# First guess of the peak GPU memory per voxel of the box (preflight.HOST_BYTES_PER_VOXEL
+# for CPU workers), before any run is recorded
+GPU_BYTES_PER_VOXEL = 256
+
+# Messages of torch and python when an allocation fails
+OUT_OF_MEMORY_ERRORS = ['out of memory', 'MemoryError', 'Cannot allocate memory',
+                        "can't allocate memory", 'CUBLAS_STATUS_ALLOC_FAILED']
+
+_gpuNames = {}
+_lock = threading.Lock()
+
+
+def isOutOfMemory(error):
+    return any(message in str(error) for message in OUT_OF_MEMORY_ERRORS)
+
+
+def _queryGpu(device, field):
+    """ Value of an nvidia-smi field of the GPU device, None if not available. """
+    try:
+        output = subprocess.run(['nvidia-smi', f'--query-gpu={field}',
+                                 '--format=csv,noheader,nounits', '-i', str(device)],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True, timeout=30).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.splitlines()[0].strip() if output else None
+
+
+def _firstDevice(device):
+    """ First GPU of a device list as given in CUDA_VISIBLE_DEVICES, None for CPU. """
+    device = str(device).split(',')[0].strip() if device is not None else ''
+    return device or None
+
+
+def getMachineKey(device=None):
+    """ Host name and model of the GPU device (CPU if None). """
+    device = _firstDevice(device)
+    if device is None:
+        return f"{platform.node()}/CPU"
+    if device not in _gpuNames:
+        _gpuNames[device] = _queryGpu(device, 'name') or f"GPU {device}"
+    return f"{platform.node()}/{_gpuNames[device]}"
+
+
+def getFreeMemory(device=None):
+    """ Free bytes of the GPU device, or available bytes of the host if None.
+    None if it can not be known. """
+    device = _firstDevice(device)
+    if device is not None:
+        free = _queryGpu(device, 'memory.free')  # MiB
+        return int(float(free)) * 1024 ** 2 if free else None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Tuner:
+    """ Boxes enhanced by each machine (see getMachineKey), stored in path as:
+
+        {"host/NVIDIA A100-SXM4-40GB": {"okVoxels": 16777216, "oomVoxels": null}}
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def getRecord(self, key):
+        return self._load().get(key, {})
+
+    def record(self, key, okVoxels=0, oomVoxels=None):
+        """ Record the largest box enhanced and the smallest box that ran out
+        of memory on the machine key. """
+        with _lock:
+            records = self._load()
+            entry = records.setdefault(key, {'okVoxels': 0, 'oomVoxels': None})
+            entry['okVoxels'] = max(entry['okVoxels'], okVoxels)
+            if oomVoxels is not None:
+                entry['oomVoxels'] = min(entry['oomVoxels'] or oomVoxels, oomVoxels)
+            # Memory was freed since it failed
+            if entry['oomVoxels'] is not None and entry['okVoxels'] >= entry['oomVoxels']:
+                entry['oomVoxels'] = None
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                writeJson(self.path, records)
+            except OSError:
+                pass  # Tuning is only an optimization
+
+    def getTileSize(self, key, freeBytes, bytesPerVoxel, minSize, maxSize):
+        """ Side of the largest cubic box that fits in SAFETY of freeBytes,
+        corrected with what was recorded for the machine key. """
+        size = maxSize
+        if freeBytes:
+            size = int((SAFETY * freeBytes / bytesPerVoxel) ** (1 / 3))
+        entry = self.getRecord(key)
+        if entry.get('okVoxels'):
+            size = max(size, int(round(entry['okVoxels'] ** (1 / 3))))
+        if entry.get('oomVoxels'):
+            size = min(size, getBackoffSize(round(entry['oomVoxels'] ** (1 / 3))))
+        # Multiple of 8, friendlier with the network and the FFTs
+        return max(minSize, min(maxSize, size // 8 * 8))
+
+
+def getBackoffSize(size):
+    return int(size * BACKOFF) // 8 * 8
@@ -0,0 +1,58 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Files written so that readers never see them half written.
+
+The content goes to a temporary file next to the final one, which is then
+moved onto it with os.replace. A process killed in the middle leaves the
+previous file, or none, but never a truncated one.
+"""
+
+import contextlib
+import json
+import os
+import threading
+
+
+@contextlib.contextmanager
+def atomicPath(path):
+    """ Temporary path to write instead of path. It replaces path when the
+    block ends and is removed if the block fails. The name is unique to the
+    process and thread, so concurrent writers do not mix their content. """
+    tmpPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmpPath
+        os.replace(tmpPath, path)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+def writeJson(path, data):
+    """ Write data to path as indented JSON, atomically. """
+    with atomicPath(path) as tmpPath:
+        with open(tmpPath, 'w') as f:
+            json.dump(data, f, indent=2)
@@ -0,0 +1,117 @@
+# **************************************************************************
+# *
+# * Authors:     Javier Sanchez (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import subprocess
+import time
+
+from .runner import ProcessRunner
+
+
+class CryotenWorker:
+    """ Client side of a persistent cryoten worker (see scripts/cryoten_worker.py).
+
+    The worker process is started once and then receives one job per volume,
+    so the cryoten model is loaded a single time for a whole set of volumes.
+    The output of cryoten is forwarded to the protocol log while it runs,
+    prefixed with name. It can be used as a context manager:
+
+        with CryotenWorker(command, cwd=cryotenPath) as worker:
+            worker.enhance(inputPath, outputPath)
+    """
+    def __init__(self, command, env=None, cwd=None, name='cryoten'):
+        self.name = name
+        self._runner = ProcessRunner(command, env=env, cwd=cwd, prefix=f"[{name}] ",
+                                     interactive=True)
+        self._process = None
+        self._cancelled = False
+        self._jobCounter = 0
+        self.startupSeconds = None
+        self.startupCpu = None
+
+    def start(self):
+        """ Launch the worker and wait until it is ready to accept jobs. """
+        if self._cancelled:
+            raise RuntimeError("Cryoten worker cancelled before starting")
+        t0 = time.time()
+        self._process = self._runner.start()
+        reply = self._readReply()
+        # Including the interpreter start-up and imports
+        self.startupSeconds = time.time() - t0
+        self.startupCpu = reply.get('cpu')
+        return self
+
+    def enhance(self, inputPath, outputPath):
+        """ Enhance a single map and return the reply of the worker. """
+        self._jobCounter += 1
+        job = {'id': self._jobCounter, 'input': inputPath, 'output': outputPath}
+        try:
+            self._process.stdin.write(json.dumps(job) + '\n')
+            self._process.stdin.flush()
+        except OSError:  # BrokenPipeError if the worker is gone
+            self._raiseExited()
+
+        reply = self._readReply()
+        if not reply.get('ok'):
+            raise RuntimeError(f"Cryoten failed to enhance {inputPath}: {reply.get('error')}")
+        return reply
+
+    def close(self, timeout=60):
+        """ Ask the worker to finish and wait for it, stopping it if it
+        does not finish in timeout seconds. """
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.write('\n')
+            self._process.stdin.close()
+            self._process.wait(timeout)
+        except (BrokenPipeError, ValueError, subprocess.TimeoutExpired):
+            self._process.terminate()
+        self._process = None
+
+    def terminate(self):
+        """ Stop the worker (and its children) right away, e.g. to cancel its job. """
+        self._cancelled = True
+        if self._process is not None:
+            self._process.terminate()
+
+    def _readReply(self):
+        line = self._process.stdout.readline()
+        if not line:
+            self._raiseExited()
+        return json.loads(line)
+
+    def _raiseExited(self):
+        returnCode = self._process.wait()
+        raise RuntimeError(f"Cryoten worker exited unexpectedly with code {returnCode}:\n"
+                           + '\n'.join(self._process.tail))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.terminate()